@@ -0,0 +1,220 @@
+""" Load test of the classification API against local stand-in services.
+    Starts the fake inference/path services and the classification app, drives /classify
+    (or /classify/batch) at the given concurrency with the bank pictures, and reports
+    latency percentiles, throughput and CPU per request as JSON. """
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from glob import glob
+
+import httpx
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+CONTAINER_DIR = os.path.join(BENCHMARK_DIR, '..', 'container')
+sys.path.insert(0, CONTAINER_DIR)
+from picture_bank import bank_folders # pylint: disable=wrong-import-position
+
+def bank_tiles(pictures_dir):
+    """ One tile per bank picture, as a drone would send it """
+    tiles = []
+    for (kind, disease), folder in bank_folders.items():
+        for frame in range(len(glob(os.path.join(pictures_dir, folder, '*')))):
+            tiles.append({
+                "coordinates": (715, 822),
+                "kind": kind,
+                "status": "",
+                "disease": disease,
+                "frame": frame,
+                "uuid": "benchmark"
+            })
+    return tiles
+
+def process_stats():
+    """ Parent pid and user + system CPU time of every process (Linux only) """
+    stats = dict()
+    for stat_path in glob('/proc/[0-9]*/stat'):
+        try:
+            with open(stat_path, encoding='utf-8') as stat_file:
+                fields = stat_file.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        stats[int(stat_path.split('/')[2])] = \
+            (int(fields[1]), (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK'))
+    return stats
+
+def cpu_seconds(pid):
+    """ CPU time of a process and its children, e.g. the app workers when WORKERS > 1,
+        None if not available """
+    stats = process_stats()
+    if pid not in stats:
+        return None
+    tree = {pid}
+    while True:
+        children = {child for child, (ppid, _) in stats.items() \
+            if ppid in tree and child not in tree}
+        if not children:
+            break
+        tree |= children
+    return sum(stats[process][1] for process in tree)
+
+def start_process(args, cwd, env, verbose):
+    """ Starts a service in the background """
+    output = None if verbose else subprocess.DEVNULL
+    return subprocess.Popen([sys.executable, *args], cwd=cwd, env=env, \
+        stdout=output, stderr=output)
+
+def wait_ready(url, process, timeout=120):
+    """ Waits for a service to answer """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'{url} exited with code {process.returncode}')
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.TransportError:
+            time.sleep(0.2)
+    raise RuntimeError(f'{url} not ready after {timeout}s')
+
+async def drive(url, requests_list, concurrency):
+    """ Sends all requests with `concurrency` clients, returns latencies and error count """
+    latencies = []
+    errors = 0
+    next_request = iter(requests_list)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        async def worker():
+            nonlocal errors
+            for payload in next_request:
+                start = time.perf_counter()
+                try:
+                    response = await client.post(url, json=payload)
+                    response.raise_for_status()
+                except httpx.HTTPError:
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - start)
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return latencies, errors
+
+def summarize(latencies, errors, duration, cpu, nb_tiles):
+    """ Machine-readable results """
+    latencies_ms = np.array(latencies) * 1000
+    completed = len(latencies)
+    return {
+        'requests': completed,
+        'errors': errors,
+        'tiles': nb_tiles,
+        'duration_s': round(duration, 3),
+        'requests_per_s': round(completed / duration, 2) if duration else None,
+        'tiles_per_s': round(nb_tiles / duration, 2) if duration else None,
+        'latency_ms': {
+            'p50': round(float(np.percentile(latencies_ms, 50)), 3),
+            'p95': round(float(np.percentile(latencies_ms, 95)), 3),
+            'p99': round(float(np.percentile(latencies_ms, 99)), 3),
+            'mean': round(float(latencies_ms.mean()), 3),
+            'max': round(float(latencies_ms.max()), 3)
+        } if completed else None,
+        'cpu_ms_per_request': round(cpu * 1000 / completed, 3) \
+            if cpu is not None and completed else None
+    }
+
+def main():
+    """ Runs the benchmark """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--warmup', type=int, default=100, help='requests not measured')
+    parser.add_argument('--endpoint', choices=['classify', 'batch'], default='classify')
+    parser.add_argument('--batch-size', type=int, default=20, help='tiles per /classify/batch')
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='fake inference latency')
+    parser.add_argument('--jitter-ms', type=float, default=5.0, help='fake inference jitter')
+    parser.add_argument('--cache', action='store_true', help='keep the prediction cache enabled')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE', \
+        help='extra environment for the classification app, e.g. INFERENCE_PAYLOAD_MODE=binary')
+    parser.add_argument('--app-port', type=int, default=5102)
+    parser.add_argument('--fake-port', type=int, default=5103)
+    parser.add_argument('--output', help='JSON results file, default is stdout')
+    parser.add_argument('--verbose', action='store_true', help='show the services output')
+    args = parser.parse_args()
+
+    fake_url = f'http://127.0.0.1:{args.fake_port}'
+    app_url = f'http://127.0.0.1:{args.app_port}'
+    app_env = dict(os.environ)
+    app_env.update({
+        'PORT': str(args.app_port),
+        'INFERENCE_BACKEND': 'remote',
+        'INFERENCE_ENDPOINT': fake_url + '/v2/models/crops/infer',
+        'PATHSERVICE_ENDPOINT': fake_url,
+        'PREDICTION_CACHE_SIZE': os.environ.get('PREDICTION_CACHE_SIZE', '1024') \
+            if args.cache else '0'
+    })
+    app_env.update(item.split('=', 1) for item in args.env)
+
+    tiles = bank_tiles(os.path.join(CONTAINER_DIR, 'assets', 'pictures'))
+    nb_requests = args.warmup + args.requests
+    if args.endpoint == 'batch':
+        url = app_url + '/classify/batch'
+        payloads = [[tiles[(i * args.batch_size + j) % len(tiles)] \
+            for j in range(args.batch_size)] for i in range(nb_requests)]
+    else:
+        url = app_url + '/classify'
+        payloads = [tiles[i % len(tiles)] for i in range(nb_requests)]
+
+    fake = start_process([os.path.join(BENCHMARK_DIR, 'fake_services.py'), \
+        '--port', str(args.fake_port), '--latency-ms', str(args.latency_ms), \
+        '--jitter-ms', str(args.jitter_ms)], BENCHMARK_DIR, os.environ, args.verbose)
+    app = None
+    try:
+        wait_ready(fake_url + '/status', fake)
+        app = start_process(['app.py'], CONTAINER_DIR, app_env, args.verbose)
+        wait_ready(app_url + '/status', app)
+
+        asyncio.run(drive(url, payloads[:args.warmup], args.concurrency))
+
+        cpu_start = cpu_seconds(app.pid)
+        start = time.perf_counter()
+        latencies, errors = asyncio.run(drive(url, payloads[args.warmup:], args.concurrency))
+        duration = time.perf_counter() - start
+        cpu_end = cpu_seconds(app.pid)
+        counters = httpx.get(fake_url + '/counters').json()
+    finally:
+        for process in (app, fake):
+            if process is not None:
+                process.terminate()
+                process.wait()
+
+    # The settings above win over a local .env of the app, check the fake service was used
+    if app_env['INFERENCE_BACKEND'] == 'remote' and counters['inference_calls'] == 0:
+        raise RuntimeError(f'The app did not call the fake inference service at {fake_url}')
+    cpu = cpu_end - cpu_start if cpu_start is not None and cpu_end is not None else None
+    nb_tiles = len(latencies) * (args.batch_size if args.endpoint == 'batch' else 1)
+    report = {
+        'config': {
+            'endpoint': args.endpoint,
+            'concurrency': args.concurrency,
+            'requests': args.requests,
+            'warmup': args.warmup,
+            'batch_size': args.batch_size if args.endpoint == 'batch' else 1,
+            'fake_latency_ms': args.latency_ms,
+            'fake_jitter_ms': args.jitter_ms,
+            'prediction_cache': args.cache,
+            'env': dict(item.split('=', 1) for item in args.env)
+        },
+        'results': summarize(latencies, errors, duration, cpu, nb_tiles),
+        'fake_services': counters
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            output_file.write(output + '\n')
+    print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+""" Stand-in services for benchmarking the classification API:
+    a KServe v2 inference endpoint with configurable latency, and a path service stub. """
+import argparse
+import asyncio
+import json
+import random
+
+import numpy as np
+from fastapi import FastAPI, Request, Response
+from uvicorn import run
+
+# Number of classes returned by the crops model
+NB_CLASSES = 14
+HEADER_LENGTH = 'Inference-Header-Content-Length'
+
+app = FastAPI()
+
+# Set from the command line
+settings = {'latency_ms': 20.0, 'jitter_ms': 5.0}
+counters = {'inference_calls': 0, 'pictures': 0, 'destinations': 0}
+
+async def simulate_latency():
+    """ Waits like a model server would """
+    delay = random.gauss(settings['latency_ms'], settings['jitter_ms']) / 1000
+    await asyncio.sleep(max(0.0, delay))
+
+@app.post("/v2/models/{model_name}/infer")
+async def infer(model_name: str, request: Request):
+    """ Returns random class scores, one row per picture """
+    body = await request.body()
+    header_length = request.headers.get(HEADER_LENGTH)
+    header = json.loads(body[:int(header_length)] if header_length else body)
+    batch_size = header['inputs'][0]['shape'][0]
+    counters['inference_calls'] += 1
+    counters['pictures'] += batch_size
+
+    await simulate_latency()
+
+    scores = np.random.rand(batch_size, NB_CLASSES)
+    scores /= scores.sum(axis=1, keepdims=True)
+    return {
+        "model_name": model_name,
+        "outputs": [{
+            "name": "dense",
+            "datatype": "FP32",
+            "shape": [batch_size, NB_CLASSES],
+            "data": scores.flatten().tolist()
+        }]
+    }
+
+@app.put("/destination")
+async def add_destination_entry(request: Request):
+    """ Path service stub """
+    await request.body()
+    counters['destinations'] += 1
+    return True
+
+@app.put("/destinations")
+async def add_destination_entries(request: Request):
+    """ Path service stub, bulk version """
+    entry = await request.json()
+    counters['destinations'] += len(entry['coordinates'])
+    return True
+
+@app.get("/counters")
+async def get_counters():
+    """ Calls received so far """
+    return counters
+
+@app.get("/status")
+async def status():
+    """ Simple status check """
+    return Response()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--port', type=int, default=5100)
+    parser.add_argument('--latency-ms', type=float, default=20.0)
+    parser.add_argument('--jitter-ms', type=float, default=5.0)
+    args = parser.parse_args()
+    settings['latency_ms'] = args.latency_ms
+    settings['jitter_ms'] = args.jitter_ms
+    run(app, host="127.0.0.1", port=args.port, log_level="warning")
@@ -1,35 +1,97 @@
 """ Classification API. Receives field data and sends back prediction. """
+import asyncio
+import hashlib
 import io
+import json
 import os
 import uuid
-from glob import glob
 from typing import Tuple
 
-import numpy as np
-import requests
 from dotenv import load_dotenv
-from fastapi import FastAPI, File, UploadFile
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import PlainTextResponse
+from fastapi.routing import APIRoute
 from numpy import argmax, array
 from numpy import max as max_
 from PIL import Image
-from pydantic import BaseModel
-from tensorflow import expand_dims
-from tensorflow.keras.utils import img_to_array, load_img
+from pydantic import BaseModel, ValidationError
 from uvicorn import run
 
-# Load local env vars if present
-load_dotenv(override=True)
+import http_client
+import metrics
+from backends import OnnxBackend, RemoteBackend
+from batching import MicroBatcher
+from destination_dispatcher import DestinationDispatcher
+from picture_bank import PictureBank
+from prediction_cache import PredictionCache
+from preprocess_pool import PreprocessPool
+from static_assets import CompressedStaticFiles, precompress
+
+# Load local env vars if present. They do not override the environment: the workers
+# get settings from the parent process (STATIC_PRECOMPRESS, PICTURE_BANK_SHM)
+load_dotenv()
+# Inference backend: 'remote' or 'onnx'
+INFERENCE_BACKEND = os.getenv('INFERENCE_BACKEND', 'remote')
+# ONNX Runtime backend: model file, thread counts (0 = default) and graph optimization
+# level ('disable', 'basic', 'extended' or 'all')
+ONNX_MODEL_PATH = os.getenv('ONNX_MODEL_PATH', './model/crops.onnx')
+ONNX_INTRA_OP_THREADS = int(os.getenv('ONNX_INTRA_OP_THREADS', '0'))
+ONNX_INTER_OP_THREADS = int(os.getenv('ONNX_INTER_OP_THREADS', '0'))
+ONNX_OPTIMIZATION_LEVEL = os.getenv('ONNX_OPTIMIZATION_LEVEL', 'all')
 # External services
 INFERENCE_ENDPOINT = os.getenv('INFERENCE_ENDPOINT', '')
 PATHSERVICE_ENDPOINT = os.getenv('PATHSERVICE_ENDPOINT', '')
+# Inference payload: 'json' or 'binary' (v2 binary tensor extension)
+INFERENCE_PAYLOAD_MODE = os.getenv('INFERENCE_PAYLOAD_MODE', 'json')
+# Model input datatype: 'FP32', or 'UINT8' if the model accepts it
+INFERENCE_INPUT_DATATYPE = os.getenv('INFERENCE_INPUT_DATATYPE', 'FP32')
+# Outbound HTTP calls: connection pool limits, timeouts (s) and retry budgets
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', '100'))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('HTTP_MAX_KEEPALIVE_CONNECTIONS', '20'))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv('HTTP_KEEPALIVE_EXPIRY', '30'))
+INFERENCE_TIMEOUT = float(os.getenv('INFERENCE_TIMEOUT', '30'))
+INFERENCE_RETRIES = int(os.getenv('INFERENCE_RETRIES', '2'))
+PATHSERVICE_TIMEOUT = float(os.getenv('PATHSERVICE_TIMEOUT', '10'))
+PATHSERVICE_RETRIES = int(os.getenv('PATHSERVICE_RETRIES', '2'))
+# Per-request stage timings in a Server-Timing response header
+STAGE_TIMINGS_HEADER = os.getenv('STAGE_TIMINGS_HEADER', 'false').lower() == 'true'
+# Max size of uploaded pictures, in bytes
+UPLOAD_MAX_BYTES = int(os.getenv('UPLOAD_MAX_BYTES', str(20 * 1024 * 1024)))
+# Classification stream: max tiles in flight per WebSocket connection
+WS_MAX_IN_FLIGHT = int(os.getenv('WS_MAX_IN_FLIGHT', '32'))
+# Decoding of uploaded pictures: 'none' (on the event loop), 'thread' or 'process' pool,
+# number of workers and max pictures in flight (0 = one worker per CPU, 2 per worker)
+PREPROCESS_EXECUTOR = os.getenv('PREPROCESS_EXECUTOR', 'none')
+PREPROCESS_WORKERS = int(os.getenv('PREPROCESS_WORKERS', '0'))
+PREPROCESS_MAX_PENDING = int(os.getenv('PREPROCESS_MAX_PENDING', '0'))
+# Destinations queue: max size, coalescing window and max path service calls
+# in flight (failed calls are retried PATHSERVICE_RETRIES times)
+DESTINATION_QUEUE_SIZE = int(os.getenv('DESTINATION_QUEUE_SIZE', '1000'))
+DESTINATION_WINDOW_MS = float(os.getenv('DESTINATION_WINDOW_MS', '100'))
+DESTINATION_MAX_IN_FLIGHT = int(os.getenv('DESTINATION_MAX_IN_FLIGHT', '4'))
+# Prediction cache (a size of 0 disables it, a TTL of 0 keeps entries until evicted)
+PREDICTION_CACHE_SIZE = int(os.getenv('PREDICTION_CACHE_SIZE', '1024'))
+PREDICTION_CACHE_TTL = float(os.getenv('PREDICTION_CACHE_TTL', '0'))
+MODEL_VERSION = os.getenv('MODEL_VERSION', '')
+# Micro-batching of concurrent requests (a max size of 1 disables batching)
+BATCH_MAX_SIZE = int(os.getenv('BATCH_MAX_SIZE', '8'))
+BATCH_MAX_WAIT_MS = float(os.getenv('BATCH_MAX_WAIT_MS', '5'))
 # Frontend configuration - (PATHSERVICE_ENDPOINT already initialized)
 CLASSIFICATION_ENDPOINT = os.environ.get('CLASSIFICATION_ENDPOINT', 'http://localhost:5002')
 DRONE_SPEED = float(os.environ.get('DRONE_SPEED', '0.5'))
 TRACTOR_SPEED = float(os.environ.get('TRACTOR_SPEED', '0.1'))
 COMM_SPEED = float(os.environ.get('COMM_SPEED', '1'))
 WEALTHY_CROP_INITIAL_PERCENTAGE = int(os.environ.get('WEALTHY_CROP_INITIAL_PERCENTAGE', '50'))
+# Frontend text assets are precompressed at startup if the image build has not done it
+STATIC_PRECOMPRESS = os.getenv('STATIC_PRECOMPRESS', 'true').lower() == 'true'
+# Picture banks
+PICTURES_DIR = os.getenv('PICTURES_DIR', './assets/pictures')
+PICTURE_BANK_CACHE = os.getenv('PICTURE_BANK_CACHE', '')
+# Shared memory segment of the picture bank, set by the main process for its workers
+PICTURE_BANK_SHM = os.getenv('PICTURE_BANK_SHM', '')
+# Server worker processes, they share one decoded picture bank
+WORKERS = int(os.getenv('WORKERS', '1'))
 
 # App creation
 app = FastAPI()
@@ -105,24 +167,112 @@ class TileStatus(BaseModel):
             }
         }
 
-# Initialize picture banks arrays with full relative path
-wheat_healthy = sorted(glob(os.path.join('./assets/pictures/wheat_healthy/','*')))
-wheat_brown_rust = sorted(glob(os.path.join('./assets/pictures/wheat_brown_rust/','*')))
-wheat_yellow_rust = sorted(glob(os.path.join('./assets/pictures/wheat_yellow_rust/','*')))
-corn_common_rust = sorted(glob(os.path.join('./assets/pictures/corn_common_rust/','*')))
-corn_gray_leaf_spot = sorted(glob(os.path.join('./assets/pictures/corn_gray_leaf_spot/','*')))
-corn_healthy = sorted(glob(os.path.join('./assets/pictures/corn_healthy/','*')))
-corn_northern_leaf_blight = sorted(glob(os.path.join('./assets/pictures/corn_northern_leaf_blight/','*'))) # pylint: disable=line-too-long
-potato_early_blight = sorted(glob(os.path.join('./assets/pictures/potato_early_blight/','*')))
-potato_healthy = sorted(glob(os.path.join('./assets/pictures/potato_healthy/','*')))
-potato_late_blight = sorted(glob(os.path.join('./assets/pictures/potato_late_blight/','*')))
-
-def add_path_entry(kind,coordinates,uuid):
-    """ Calls the API to add a field to the array of places to visit """
-    data_json = {"kind": kind, "coordinates": coordinates, "uuid": uuid}
-    print(PATHSERVICE_ENDPOINT + '/destination')
-    resp = requests.put(url = PATHSERVICE_ENDPOINT + '/destination', json=data_json, timeout=10)
-    print('Path entry added')
+# Picture banks, decoded once at startup
+picture_bank = PictureBank(PICTURES_DIR, PICTURE_BANK_CACHE, PICTURE_BANK_SHM)
+
+# Predictions of bank pictures, per model version
+prediction_cache = PredictionCache(PREDICTION_CACHE_SIZE, PREDICTION_CACHE_TTL, MODEL_VERSION)
+
+# Outbound calls share one connection pool
+http = http_client.create_client(HTTP_MAX_CONNECTIONS, \
+    HTTP_MAX_KEEPALIVE_CONNECTIONS, HTTP_KEEPALIVE_EXPIRY)
+
+async def add_path_entries(kind,coordinates_list,uuid):
+    """ Calls the API to add several fields at once to the array of places to visit """
+    data_json = {"kind": kind, "coordinates": coordinates_list, "uuid": uuid}
+    print(PATHSERVICE_ENDPOINT + '/destinations')
+    with metrics.stage('pathservice'):
+        await http_client.request(http, 'PUT', PATHSERVICE_ENDPOINT + '/destinations', \
+            PATHSERVICE_TIMEOUT, PATHSERVICE_RETRIES, json=data_json)
+    print(f'{len(coordinates_list)} path entries added')
+
+# Ill fields are sent to the path service in the background
+dispatcher = DestinationDispatcher(add_path_entries, DESTINATION_QUEUE_SIZE, \
+    DESTINATION_WINDOW_MS, DESTINATION_MAX_IN_FLIGHT)
+
+# Inference backend: remote ModelMesh/KServe endpoint or in-process ONNX Runtime
+if INFERENCE_BACKEND == 'onnx':
+    backend = OnnxBackend(ONNX_MODEL_PATH, ONNX_INTRA_OP_THREADS, \
+        ONNX_INTER_OP_THREADS, ONNX_OPTIMIZATION_LEVEL)
+else:
+    backend = RemoteBackend(http, INFERENCE_ENDPOINT, INFERENCE_PAYLOAD_MODE, \
+        INFERENCE_INPUT_DATATYPE, INFERENCE_TIMEOUT, INFERENCE_RETRIES)
+
+# Concurrent classification requests are sent together to the inference backend
+batcher = MicroBatcher(backend.predict, BATCH_MAX_SIZE, BATCH_MAX_WAIT_MS)
+
+# Uploaded pictures are decoded off the event loop
+preprocess_pool = PreprocessPool(PREPROCESS_EXECUTOR, PREPROCESS_WORKERS, PREPROCESS_MAX_PENDING)
+
+@app.on_event("startup")
+def load_picture_bank():
+    """ Decodes all bank pictures before serving requests """
+    picture_bank.load()
+
+@app.on_event("startup")
+def load_backend():
+    """ Prepares the inference backend """
+    backend.load()
+
+@app.on_event("startup")
+async def start_batcher():
+    """ Starts collecting classification requests """
+    batcher.start()
+
+@app.on_event("startup")
+async def start_dispatcher():
+    """ Starts sending destinations to the path service """
+    dispatcher.start()
+
+@app.on_event("shutdown")
+async def stop_batcher():
+    """ Waits for the batches and destinations in flight, then closes the connection pool """
+    await batcher.stop()
+    await dispatcher.stop()
+    await http.aclose()
+
+@app.on_event("startup")
+async def start_preprocess_pool():
+    """ Starts the preprocessing workers """
+    preprocess_pool.start()
+
+@app.on_event("shutdown")
+def stop_preprocess_pool():
+    """ Stops the preprocessing workers """
+    preprocess_pool.stop()
+
+@app.on_event("shutdown")
+def release_picture_bank():
+    """ Detaches from the shared picture bank, the main process removes it """
+    picture_bank.release()
+
+# Paths of the API endpoints, other paths are counted as static files in the metrics
+api_paths = set()
+
+@app.middleware("http")
+async def record_metrics(request: Request, call_next):
+    """ Counts requests and reports their stage timings if enabled """
+    if not api_paths:
+        api_paths.update(route.path for route in app.routes if isinstance(route, APIRoute))
+    endpoint = request.url.path if request.url.path in api_paths else 'static'
+    timings = dict()
+    metrics.request_timings.set(timings)
+    metrics.request_started(endpoint)
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+    finally:
+        metrics.request_ended(endpoint, status_code)
+    if STAGE_TIMINGS_HEADER and timings:
+        response.headers['Server-Timing'] = metrics.server_timing(timings)
+    return response
+
+# Metrics API
+@app.get("/metrics", response_class = PlainTextResponse)
+async def get_metrics():
+    """ Stage latencies, request counts and requests in flight, in Prometheus text format """
+    return metrics.render()
 
 # Status API
 @app.get("/status")
@@ -130,82 +280,206 @@ async def status():
     """ Simple status check """
     return {"message": "Status:OK"}
 
-# Classification API
-@app.post("/classify", response_model = TileStatus)
-async def classify(entry: TileEntry):
-    """ Classification API """
+# Prediction cache API
+@app.get("/cache")
+async def cache_stats():
+    """ Prediction cache hit/miss counters """
+    return prediction_cache.stats()
 
-    if entry.kind == "wheat":
-        if entry.disease == "Wheat___Healthy":
-            picture_path = wheat_healthy[entry.frame]
-        if entry.disease == "Wheat___Brown_Rust":
-            picture_path = wheat_brown_rust[entry.frame]
-        if entry.disease == "Wheat___Yellow_Rust":
-            picture_path = wheat_yellow_rust[entry.frame]
-
-    if entry.kind == "corn":
-        if entry.disease == "Corn___Common_Rust":
-            picture_path = corn_common_rust[entry.frame]
-        if entry.disease == "Corn___Gray_Leaf_Spot":
-            picture_path = corn_gray_leaf_spot[entry.frame]
-        if entry.disease == "Corn___Healthy":
-            picture_path = corn_healthy[entry.frame]
-        if entry.disease == "Corn___Northern_Leaf_Blight":
-            picture_path = corn_northern_leaf_blight[entry.frame]
-
-    if entry.kind == "potato":
-        if entry.disease == "Potato___Early_Blight":
-            picture_path = potato_early_blight[entry.frame]
-        if entry.disease == "Potato___Healthy":
-            picture_path = potato_healthy[entry.frame]
-        if entry.disease == "Potato___Late_Blight":
-            picture_path = potato_late_blight[entry.frame]
-
-    #file =  {'file': open(picture_path, 'rb')}
-
-    img = load_img(picture_path, target_size=(200, 200))
-    img_array = img_to_array(img) # Transform image to array
-    img_array = expand_dims(img_array, 0) # Expand dimension as expected by inference point
-
-    # json payload
-    img_numpy = img_array.numpy() # Convert to numpy array
-    im_json = img_numpy.tolist() # Converts to a nested list for json payload
-    
-    # ModelMesh expected input format
-    # (get model input "name" and "shape" from your model)
-    data = {
-        "inputs": [
-            { 
-                "name": "input_1",
-                "shape": [1,200,200,3],
-                "datatype": "FP32",
-                "data": im_json
-            }
-        ]
-    }
+@app.delete("/cache")
+async def invalidate_cache(model_version: str = None):
+    """ Drops cached predictions, to be called when the model is redeployed """
+    prediction_cache.invalidate(model_version)
+    return prediction_cache.stats()
 
-    # Call the inference point
-    response = requests.post(INFERENCE_ENDPOINT, json=data)
-    raw_output = response.json() # Extract to Json
-    arr = np.array(raw_output['outputs'][0]['data']) # Get the response data as a NumPy Array
-    # Retrieve result
+def read_prediction(arr):
+    """ Predicted class and confidence score from a model output row """
     class_prediction = class_predictions[argmax(arr)]
     score = max_(arr)
     model_score = round(score * 100, 2)
-    result = {}
+    return class_prediction, model_score
+
+def tile_status(entry, prediction):
+    """ Data sent back to the drone """
+    response = TileStatus()
     if entry.disease in ["Wheat___Healthy","Corn___Healthy","Potato___Healthy"]:
-        result['status'] = 'healthy'
+        response.status = 'healthy'
     else:
-        result['status'] = 'ill'
-        add_path_entry(entry.kind, entry.coordinates,entry.uuid)
+        response.status = 'ill'
+    response.model_prediction, response.model_prediction_confidence_score = prediction
+    return response
+
+def unknown_picture(ex):
+    """ Error for a tile whose kind, disease or frame has no bank picture """
+    return HTTPException(status_code=400, detail=f'Unknown picture: {ex}')
+
+# Classification API
+@app.post("/classify", response_model = TileStatus)
+async def classify(entry: TileEntry):
+    """ Classification API """
+
+    # Same picture and model always give the same prediction
+    with metrics.stage('lookup'):
+        try:
+            picture_key = picture_bank.picture_path(entry.kind, entry.disease, entry.frame)
+        except (KeyError, IndexError) as ex:
+            raise unknown_picture(ex) from ex
+        prediction = prediction_cache.get(picture_key)
+        if prediction is None:
+            # Picture is already decoded, resized and expanded as expected by inference point
+            img_numpy = picture_bank.get(entry.kind, entry.disease, entry.frame)
+
+    if prediction is None:
+        # Call the inference point, batched with concurrent requests
+        with metrics.stage('prediction'):
+            arr = (await batcher.predict(img_numpy))[0]
+        # Retrieve result
+        prediction = read_prediction(arr)
+        prediction_cache.put(picture_key, prediction)
+
+    response = tile_status(entry, prediction)
+    if response.status == 'ill':
+        await dispatcher.add(entry.kind, entry.coordinates, entry.uuid)
+
+    return response
+
+@app.post("/classify/batch", response_model = list[TileStatus])
+async def classify_batch(entries: list[TileEntry]):
+    """ Classifies all the tiles of a drone pass, in order """
+    with metrics.stage('lookup'):
+        try:
+            picture_keys = [picture_bank.picture_path(entry.kind, entry.disease, entry.frame) \
+                for entry in entries]
+        except (KeyError, IndexError) as ex:
+            raise unknown_picture(ex) from ex
+        predictions = [prediction_cache.get(picture_key) for picture_key in picture_keys]
+
+        # All pictures without a cached prediction go in one inference call
+        missing = [i for i, prediction in enumerate(predictions) if prediction is None]
+        if missing:
+            img_batch = picture_bank.get_many([(entries[i].kind, entries[i].disease, \
+                entries[i].frame) for i in missing])
+    if missing:
+        with metrics.stage('prediction'):
+            outputs = await backend.predict(img_batch)
+        for i, arr in zip(missing, outputs):
+            predictions[i] = read_prediction(arr)
+            prediction_cache.put(picture_keys[i], predictions[i])
+
+    response = [tile_status(entry, prediction) for entry, prediction in zip(entries, predictions)]
+
+    # Destinations are coalesced per drone and kind of crop by the dispatcher
+    for entry, status in zip(entries, response):
+        if status.status == 'ill':
+            await dispatcher.add(entry.kind, entry.coordinates, entry.uuid)
+
+    return response
+
+@app.post("/classify/upload", response_model = TileStatus)
+async def classify_upload(request: Request, kind: str = "", uuid: str = "", \
+    x: float = None, y: float = None):
+    """ Classifies a picture sent as the raw request body (e.g. image/jpeg).
+        If the crop is ill and uuid and coordinates are given, the field is
+        added to the destinations. """
+    # Body is read in memory, no temporary file
+    body = bytearray()
+    async for chunk in request.stream():
+        body.extend(chunk)
+        if len(body) > UPLOAD_MAX_BYTES:
+            raise HTTPException(status_code=413, detail="Picture too large")
+    if not body:
+        raise HTTPException(status_code=400, detail="No picture")
+
+    with metrics.stage('lookup'):
+        picture_key = hashlib.sha1(body).hexdigest()
+        prediction = prediction_cache.get(picture_key)
+    if prediction is None:
+        # Decoding errors are the only OSError or SyntaxError raised here
+        try:
+            async with preprocess_pool.decode_upload(bytes(body)) as img_numpy:
+                with metrics.stage('prediction'):
+                    arr = (await batcher.predict(img_numpy[None]))[0]
+        except (OSError, SyntaxError) as ex:
+            raise HTTPException(status_code=400, detail="Invalid picture") from ex
+        prediction = read_prediction(arr)
+        prediction_cache.put(picture_key, prediction)
 
     response = TileStatus()
-    response.status = result['status']
-    response.model_prediction = class_prediction
-    response.model_prediction_confidence_score = model_score
+    response.model_prediction, response.model_prediction_confidence_score = prediction
+    # No known disease here, so status comes from the prediction
+    if response.model_prediction.endswith('___Healthy'):
+        response.status = 'healthy'
+    else:
+        response.status = 'ill'
+        if uuid and x is not None and y is not None:
+            await dispatcher.add(kind, (x, y), uuid)
 
     return response
 
+@app.websocket("/classify/ws/{uuid}")
+async def classify_stream(websocket: WebSocket, uuid: str):
+    """ Classification stream of a drone session. Each message is a TileEntry with an "id",
+        answered with the TileStatus and the same "id" as soon as it is ready, in any order.
+        Invalid or failed tiles are answered with an "error" instead. """
+    await websocket.accept()
+    in_flight = asyncio.Semaphore(WS_MAX_IN_FLIGHT)
+    send_lock = asyncio.Lock()
+    tasks = set()
+
+    async def classify_message(message):
+        """ Classifies one tile and sends the answer back """
+        reply = {'id': message.get('id')}
+        status_code = 200
+        metrics.request_started('/classify/ws')
+        try:
+            entry = TileEntry(**{**message, 'uuid': uuid})
+            reply.update((await classify(entry)).dict())
+        except ValidationError as ex:
+            status_code = 400
+            reply['error'] = str(ex)
+        except HTTPException as ex:
+            status_code = ex.status_code
+            reply['error'] = ex.detail
+        except Exception as ex: # pylint: disable=broad-except
+            status_code = 500
+            reply['error'] = 'Classification failed'
+            print(f'Classification failed for tile {reply["id"]}: {ex!r}')
+        finally:
+            metrics.request_ended('/classify/ws', status_code)
+            in_flight.release()
+        await send(reply)
+
+    async def send(reply):
+        """ Sends a message, unless the drone has disconnected meanwhile """
+        async with send_lock:
+            try:
+                await websocket.send_json(reply)
+            except Exception: # pylint: disable=broad-except
+                # The error type depends on the WebSocket implementation of the server
+                pass
+
+    try:
+        while True:
+            text = await websocket.receive_text()
+            try:
+                message = json.loads(text)
+                if not isinstance(message, dict):
+                    raise ValueError('Tile message must be a JSON object')
+            except ValueError as ex:
+                await send({'id': None, 'error': str(ex)})
+                continue
+            # Stops reading the stream while too many tiles are in flight
+            await in_flight.acquire()
+            task = asyncio.create_task(classify_message(message))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
 # Frontend configuration
 @app.get("/config.json")
 async def status():
@@ -223,9 +497,32 @@ async def status():
     return config
 
 # Frontend serving
-app.mount("/", StaticFiles(directory="public", html=True), name="public")
+# (the frontend has to be built in the public folder beforehand)
+# (precompressed gzip/brotli variants, ETags, cache headers and range requests)
+if os.path.isdir("public"):
+    if STATIC_PRECOMPRESS:
+        precompress("public")
+    app.mount("/", CompressedStaticFiles(directory="public", html=True), name="public")
+else:
+    print("No public folder, frontend not served")
+
+def run_workers(port):
+    """ Builds the picture bank once, then starts the workers that attach to it:
+        they map the cache file if there is one, or else a shared memory segment """
+    picture_bank.load()
+    # Assets were precompressed when this module was loaded, not again in every worker
+    os.environ['STATIC_PRECOMPRESS'] = 'false'
+    if not PICTURE_BANK_CACHE:
+        os.environ['PICTURE_BANK_SHM'] = picture_bank.share()
+    try:
+        run("app:app", host="0.0.0.0", port=port, workers=WORKERS)
+    finally:
+        picture_bank.release(unlink=True)
 
 # Launch the FastAPI server
 if __name__ == "__main__":
     port = int(os.getenv('PORT', '5000'))
-    run(app, host="0.0.0.0", port=port)
+    if WORKERS > 1:
+        run_workers(port)
+    else:
+        run(app, host="0.0.0.0", port=port)
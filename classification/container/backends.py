@@ -0,0 +1,84 @@
+""" Inference backends. Predictions come from a remote ModelMesh/KServe endpoint,
+    or from the ONNX model run in process. """
+import asyncio
+
+import numpy as np
+
+import http_client
+import inference
+import metrics
+
+class InferenceBackend:
+    """ Common interface: predicts a (N,200,200,3) batch, returns N output rows """
+    def load(self):
+        """ Prepares the backend before serving requests """
+
+    async def predict(self, img_batch):
+        """ Returns the model outputs for the batch """
+        raise NotImplementedError
+
+class RemoteBackend(InferenceBackend):
+    """ Calls a ModelMesh/KServe v2 inference endpoint """
+    def __init__(self, client, endpoint, payload_mode='json', datatype='FP32', \
+        timeout=30, retries=2):
+        self.client = client
+        self.endpoint = endpoint
+        self.payload_mode = payload_mode
+        self.datatype = datatype
+        self.timeout = timeout
+        self.retries = retries
+
+    async def predict(self, img_batch):
+        # ModelMesh expected input format, as JSON or binary tensor
+        with metrics.stage('serialize'):
+            body, request_headers = inference.build_request(img_batch, \
+                self.payload_mode, self.datatype)
+        with metrics.stage('inference_call'):
+            response = await http_client.request(self.client, 'POST', self.endpoint, \
+                self.timeout, self.retries, content=body, headers=request_headers)
+        with metrics.stage('parse'):
+            return inference.parse_response(response.content, response.headers)
+
+class OnnxBackend(InferenceBackend):
+    """ Runs the ONNX model in process with ONNX Runtime, on CPU """
+    optimization_levels = {
+        'disable': 'ORT_DISABLE_ALL',
+        'basic': 'ORT_ENABLE_BASIC',
+        'extended': 'ORT_ENABLE_EXTENDED',
+        'all': 'ORT_ENABLE_ALL'
+    }
+
+    def __init__(self, model_path, intra_op_threads=0, inter_op_threads=0, \
+        optimization_level='all'):
+        self.model_path = model_path
+        # 0 lets ONNX Runtime pick the number of threads
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.optimization_level = optimization_level
+        self.session = None
+        self.input_name = None
+
+    def load(self):
+        """ Creates the inference session """
+        # Optional dependency, only needed with this backend
+        import onnxruntime # pylint: disable=import-outside-toplevel
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = self.intra_op_threads
+        options.inter_op_num_threads = self.inter_op_threads
+        options.graph_optimization_level = getattr(onnxruntime.GraphOptimizationLevel, \
+            self.optimization_levels[self.optimization_level])
+        self.session = onnxruntime.InferenceSession(self.model_path, options, \
+            providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        print(f'ONNX model loaded from {self.model_path}')
+
+    def run(self, img_batch):
+        """ Blocking inference """
+        img_batch = np.asarray(img_batch, dtype=np.float32)
+        return self.session.run(None, {self.input_name: img_batch})[0]
+
+    async def predict(self, img_batch):
+        # ONNX Runtime releases the GIL, so the event loop keeps running meanwhile
+        with metrics.stage('inference_call'):
+            return await asyncio.get_running_loop().run_in_executor(None, self.run, img_batch)
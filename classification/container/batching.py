@@ -0,0 +1,81 @@
+""" Micro-batching of concurrent classification requests into a single inference call """
+import asyncio
+
+import numpy as np
+
+import metrics
+
+class MicroBatcher:
+    """ Collects pictures from concurrent requests until max_batch_size pictures are
+        waiting or max_wait_ms has elapsed, then sends them as one (N,200,200,3) batch """
+    def __init__(self, infer, max_batch_size=8, max_wait_ms=5):
+        # Coroutine function taking a (N,200,200,3) batch, returning N output rows
+        self.infer = infer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = None
+        self.task = None
+        self.dispatches = set()
+
+    def start(self):
+        """ Starts collecting requests, must be called from the event loop """
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """ Stops collecting requests and waits for the batches in flight """
+        self.task.cancel()
+        await asyncio.gather(self.task, *self.dispatches, return_exceptions=True)
+
+    async def predict(self, img_batch):
+        """ Queues a (n,200,200,3) batch, returns its n output rows """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((img_batch, future, metrics.request_timings.get()))
+        return await future
+
+    async def run(self):
+        """ Gathers queued pictures into batches """
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self.queue.get()]
+            count = len(items[0][0])
+            deadline = loop.time() + self.max_wait
+            while count < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                items.append(item)
+                count += len(item[0])
+            # Send the batch without delaying the collection of the next one
+            dispatch = asyncio.create_task(self.dispatch(items))
+            self.dispatches.add(dispatch)
+            dispatch.add_done_callback(self.dispatches.discard)
+
+    async def dispatch(self, items):
+        """ Runs inference on a batch and fans the output rows back to each request """
+        # The backend stages run in this task, not in the requests: they are timed here,
+        # then reported in the stage timings of each request of the batch
+        batch_timings = dict()
+        metrics.request_timings.set(batch_timings)
+        try:
+            outputs = await self.infer(np.concatenate([img_batch for img_batch, _, _ in items]))
+        except Exception as ex: # pylint: disable=broad-except
+            for _, future, _ in items:
+                if not future.done():
+                    future.set_exception(ex)
+            return
+        finally:
+            for _, _, timings in items:
+                if timings is not None:
+                    for stage_name, elapsed in batch_timings.items():
+                        timings[stage_name] = timings.get(stage_name, 0) + elapsed
+
+        offset = 0
+        for img_batch, future, _ in items:
+            if not future.done():
+                future.set_result(outputs[offset:offset+len(img_batch)])
+            offset += len(img_batch)
@@ -0,0 +1,73 @@
+""" Background dispatch of the destinations to add in the path service """
+import asyncio
+
+class DestinationDispatcher:
+    """ Queues destination additions, coalesces them per (uuid, kind) over a short
+        window, and sends each group in one call, with at most max_in_flight calls
+        at a time: the queue fills up when the path service is slow """
+    def __init__(self, send, max_queue_size=1000, window_ms=100, max_in_flight=4):
+        # Coroutine function taking (kind, coordinates_list, uuid), retrying on its own
+        self.send = send
+        self.max_queue_size = max_queue_size
+        self.window = window_ms / 1000
+        self.max_in_flight = max_in_flight
+        self.queue = None
+        self.task = None
+        self.slots = None
+        # Destinations collected during the current window
+        self.pending = dict()
+        self.flushes = set()
+
+    def start(self):
+        """ Starts dispatching, must be called from the event loop """
+        self.queue = asyncio.Queue(self.max_queue_size)
+        self.slots = asyncio.Semaphore(self.max_in_flight)
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """ Sends what is still queued and waits for the calls in flight """
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        while not self.queue.empty():
+            self.coalesce(self.queue.get_nowait())
+        await self.flush()
+        await asyncio.gather(*self.flushes, return_exceptions=True)
+
+    async def add(self, kind, coordinates, uuid):
+        """ Queues a destination, waiting for room if the queue is full """
+        await self.queue.put((uuid, kind, coordinates))
+
+    def coalesce(self, item):
+        """ Groups destinations per uuid and kind of crop """
+        uuid, kind, coordinates = item
+        self.pending.setdefault((uuid, kind), []).append(coordinates)
+
+    async def run(self):
+        """ Collects destinations during the window, then sends them """
+        while True:
+            self.coalesce(await self.queue.get())
+            await asyncio.sleep(self.window)
+            # What was queued meanwhile: at most max_queue_size destinations
+            while not self.queue.empty():
+                self.coalesce(self.queue.get_nowait())
+            await self.flush()
+
+    async def flush(self):
+        """ Sends each group in the background, once fewer than max_in_flight calls
+            are in flight. Meanwhile the queue is not drained. """
+        while self.pending:
+            await self.slots.acquire()
+            uuid, kind = next(iter(self.pending))
+            coordinates_list = self.pending.pop((uuid, kind))
+            flush = asyncio.create_task(self.send_group(kind, coordinates_list, uuid))
+            self.flushes.add(flush)
+            flush.add_done_callback(self.flushes.discard)
+
+    async def send_group(self, kind, coordinates_list, uuid):
+        """ Sends a group, which is dropped if the call fails """
+        try:
+            await self.send(kind, coordinates_list, uuid)
+        except Exception as ex: # pylint: disable=broad-except
+            print(f'{len(coordinates_list)} path entries dropped for {uuid} {kind} ({ex})')
+        finally:
+            self.slots.release()
@@ -0,0 +1,29 @@
+""" Shared asynchronous HTTP client for the calls to the other services """
+import asyncio
+
+import httpx
+
+# Statuses worth retrying, the service may be restarting or overloaded
+RETRY_STATUSES = {502, 503, 504}
+
+def create_client(max_connections, max_keepalive_connections, keepalive_expiry):
+    """ Client with a keep-alive connection pool, to be shared by all requests """
+    limits = httpx.Limits(max_connections=max_connections, \
+        max_keepalive_connections=max_keepalive_connections, keepalive_expiry=keepalive_expiry)
+    return httpx.AsyncClient(limits=limits)
+
+async def request(client, method, url, timeout, retries, backoff=0.1, **kwargs):
+    """ Sends a request, retrying up to `retries` times on connection errors,
+        timeouts and unavailable service, with exponential backoff """
+    attempt = 0
+    while True:
+        try:
+            response = await client.request(method, url, timeout=timeout, **kwargs)
+            if response.status_code not in RETRY_STATUSES or attempt >= retries:
+                response.raise_for_status()
+                return response
+        except httpx.TransportError:
+            if attempt >= retries:
+                raise
+        await asyncio.sleep(backoff * 2 ** attempt)
+        attempt += 1
@@ -0,0 +1,69 @@
+""" Inference requests and responses, following the ModelMesh/KServe v2 protocol """
+import json
+
+import numpy as np
+
+# Model input name (get it from your model)
+MODEL_INPUT_NAME = 'input_1'
+
+# v2 protocol datatypes
+datatypes = {
+    'BOOL': np.bool_,
+    'UINT8': np.uint8,
+    'INT8': np.int8,
+    'INT16': np.int16,
+    'INT32': np.int32,
+    'INT64': np.int64,
+    'FP16': np.float16,
+    'FP32': np.float32,
+    'FP64': np.float64,
+}
+
+# Header giving the size of the JSON part when binary data is appended to it
+HEADER_LENGTH = 'Inference-Header-Content-Length'
+
+def build_request(img_batch, payload_mode='json', datatype='FP32'):
+    """ Builds the inference request for a (N,200,200,3) batch.
+        Returns the body and the headers to send along """
+    # Pictures are integer valued, so casting to UINT8 is lossless
+    img_batch = np.ascontiguousarray(img_batch, dtype=datatypes[datatype])
+    tensor = {
+        "name": MODEL_INPUT_NAME,
+        "shape": list(img_batch.shape),
+        "datatype": datatype
+    }
+
+    if payload_mode == 'binary':
+        # Binary tensor extension: raw bytes appended after the JSON header
+        raw = img_batch.tobytes()
+        tensor['parameters'] = {"binary_data_size": len(raw)}
+        header = json.dumps({"inputs": [tensor]}).encode()
+        headers = {
+            'Content-Type': 'application/octet-stream',
+            HEADER_LENGTH: str(len(header))
+        }
+        return header + raw, headers
+
+    tensor['data'] = img_batch.tolist() # Converts to a nested list for json payload
+    return json.dumps({"inputs": [tensor]}).encode(), {'Content-Type': 'application/json'}
+
+def parse_response(content, headers):
+    """ Extracts the first output of an inference response as a NumPy array,
+        with one row per picture of the batch """
+    header_length = headers.get(HEADER_LENGTH)
+    if header_length is None:
+        raw_output = json.loads(content)
+        binary = b''
+    else:
+        raw_output = json.loads(content[:int(header_length)])
+        binary = content[int(header_length):]
+
+    output = raw_output['outputs'][0]
+    shape = output.get('shape', [1, -1])
+    if 'data' in output:
+        arr = np.array(output['data'])
+    else:
+        # First output, so its raw bytes come first
+        size = output['parameters']['binary_data_size']
+        arr = np.frombuffer(binary[:size], dtype=datatypes[output['datatype']])
+    return arr.reshape(shape[0], -1)
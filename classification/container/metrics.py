@@ -0,0 +1,86 @@
+""" Latency metrics of the classification service, exposed in Prometheus text format """
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram:
+    """ Cumulative histogram, as Prometheus expects it """
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """ Records a value """
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+# Latency per stage, request counts per endpoint and status, requests in flight per endpoint
+stages = dict()
+requests = dict()
+in_flight = dict()
+
+# Stage timings of the current request, when they are reported back in a header
+request_timings = ContextVar('request_timings', default=None)
+
+def observe(stage_name, elapsed):
+    """ Records the duration of a stage """
+    stages.setdefault(stage_name, Histogram()).observe(elapsed)
+    timings = request_timings.get()
+    if timings is not None:
+        timings[stage_name] = timings.get(stage_name, 0) + elapsed
+
+@contextmanager
+def stage(stage_name):
+    """ Times the enclosed block as a stage """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage_name, time.perf_counter() - start)
+
+def request_started(endpoint):
+    """ Counts a request in flight """
+    in_flight[endpoint] = in_flight.get(endpoint, 0) + 1
+
+def request_ended(endpoint, status_code):
+    """ Counts a finished request """
+    in_flight[endpoint] -= 1
+    requests[(endpoint, status_code)] = requests.get((endpoint, status_code), 0) + 1
+
+def server_timing(timings):
+    """ Server-Timing header value, durations in milliseconds """
+    return ', '.join(f'{name};dur={elapsed * 1000:.2f}' for name, elapsed in timings.items())
+
+def render():
+    """ All metrics in Prometheus text format """
+    lines = [
+        '# HELP classification_stage_seconds Latency of each classification stage',
+        '# TYPE classification_stage_seconds histogram'
+    ]
+    for stage_name, histogram in sorted(stages.items()):
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            lines.append(f'classification_stage_seconds_bucket{{stage="{stage_name}",le="{bound}"}} {count}') # pylint: disable=line-too-long
+        lines.append(f'classification_stage_seconds_bucket{{stage="{stage_name}",le="+Inf"}} {histogram.count}') # pylint: disable=line-too-long
+        lines.append(f'classification_stage_seconds_sum{{stage="{stage_name}"}} {histogram.sum}')
+        lines.append(f'classification_stage_seconds_count{{stage="{stage_name}"}} ' \
+            f'{histogram.count}')
+
+    lines.append('# HELP classification_requests_total Requests handled, per endpoint and status')
+    lines.append('# TYPE classification_requests_total counter')
+    for (endpoint, status_code), count in sorted(requests.items()):
+        lines.append(f'classification_requests_total{{endpoint="{endpoint}",status="{status_code}"}} {count}') # pylint: disable=line-too-long
+
+    lines.append('# HELP classification_requests_in_flight Requests being handled, per endpoint')
+    lines.append('# TYPE classification_requests_in_flight gauge')
+    for endpoint, count in sorted(in_flight.items()):
+        lines.append(f'classification_requests_in_flight{{endpoint="{endpoint}"}} {count}')
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,161 @@
+""" Picture banks. Every bank picture is decoded and resized once into a single tensor,
+    which several worker processes can share through a cache file or shared memory. """
+import json
+import os
+from glob import glob
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from preprocessing import IMAGE_SIZE, decode_picture
+
+# Picture bank folder for each kind of crop and disease
+bank_folders = {
+    ('wheat', 'Wheat___Healthy'): 'wheat_healthy',
+    ('wheat', 'Wheat___Brown_Rust'): 'wheat_brown_rust',
+    ('wheat', 'Wheat___Yellow_Rust'): 'wheat_yellow_rust',
+    ('corn', 'Corn___Common_Rust'): 'corn_common_rust',
+    ('corn', 'Corn___Gray_Leaf_Spot'): 'corn_gray_leaf_spot',
+    ('corn', 'Corn___Healthy'): 'corn_healthy',
+    ('corn', 'Corn___Northern_Leaf_Blight'): 'corn_northern_leaf_blight',
+    ('potato', 'Potato___Early_Blight'): 'potato_early_blight',
+    ('potato', 'Potato___Healthy'): 'potato_healthy',
+    ('potato', 'Potato___Late_Blight'): 'potato_late_blight',
+}
+
+class PictureBank:
+    """ All bank pictures in one contiguous (N,200,200,3) float32 array,
+        indexed by (kind, disease, frame) """
+    def __init__(self, pictures_dir='./assets/pictures', cache_path='', shm_name=''):
+        self.pictures_dir = pictures_dir
+        # Optional .npy file used to skip decoding on restart
+        self.cache_path = cache_path
+        # Optional shared memory segment holding the tensor built by another process
+        self.shm_name = shm_name
+        self.shm = None
+        self.paths = []
+        self.offsets = dict()
+        self.tensors = None
+
+    def index(self):
+        """ Lists the pictures of each bank and their position in the tensor """
+        self.paths = []
+        self.offsets = dict()
+        for key, folder in bank_folders.items():
+            bank = sorted(glob(os.path.join(self.pictures_dir, folder, '*')))
+            self.offsets[key] = (len(self.paths), len(bank))
+            self.paths.extend(bank)
+
+    def manifest(self):
+        """ Describes the pictures the tensor was built from """
+        return {
+            'image_size': list(IMAGE_SIZE),
+            'pictures': [[path, os.path.getsize(path)] for path in self.paths]
+        }
+
+    def manifest_path(self):
+        """ The manifest is stored next to the cached tensor """
+        return os.path.splitext(self.cache_path)[0] + '.json'
+
+    def load(self):
+        """ Builds the tensor, or maps it from shared memory or from the cache file
+            if it is still valid """
+        self.index()
+        if self.shm_name:
+            self.attach()
+            print(f'Picture bank attached to shared memory {self.shm_name}')
+            return
+        if self.cache_path and self.load_cache():
+            print(f'Picture bank loaded from {self.cache_path}')
+            return
+        self.build()
+        if self.cache_path:
+            self.save_cache()
+        print(f'Picture bank ready ({len(self.paths)} pictures)')
+
+    def build(self):
+        """ Decodes every picture into the tensor """
+        self.tensors = np.empty((len(self.paths), *IMAGE_SIZE, 3), dtype=np.float32)
+        for i, path in enumerate(self.paths):
+            self.tensors[i] = decode_picture(path)
+
+    def load_cache(self):
+        """ Memory-maps the cached tensor, returns False if missing or stale """
+        try:
+            with open(self.manifest_path(), encoding='utf-8') as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest != self.manifest():
+                return False
+            tensors = np.load(self.cache_path, mmap_mode='r')
+        except (OSError, ValueError):
+            return False
+        if tensors.shape != (len(self.paths), *IMAGE_SIZE, 3) or tensors.dtype != np.float32:
+            return False
+        self.tensors = tensors
+        return True
+
+    def save_cache(self):
+        """ Writes the tensor and its manifest, then maps the tensor back read-only """
+        try:
+            tmp_path = self.cache_path + '.tmp'
+            with open(tmp_path, 'wb') as cache_file:
+                np.save(cache_file, self.tensors)
+            os.replace(tmp_path, self.cache_path)
+            with open(self.manifest_path(), 'w', encoding='utf-8') as manifest_file:
+                json.dump(self.manifest(), manifest_file)
+        except OSError as ex:
+            print(f'Picture bank cache not saved: {ex}')
+            return
+        self.tensors = np.load(self.cache_path, mmap_mode='r')
+
+    def share(self):
+        """ Moves the tensor to a new shared memory segment, returns the segment name """
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, self.tensors.nbytes))
+        tensors = np.ndarray(self.tensors.shape, dtype=np.float32, buffer=self.shm.buf)
+        tensors[:] = self.tensors
+        self.tensors = tensors
+        self.shm_name = self.shm.name
+        return self.shm_name
+
+    def attach(self):
+        """ Maps the tensor from the shared memory segment, read-only and without copy """
+        shape = (len(self.paths), *IMAGE_SIZE, 3)
+        self.shm = shared_memory.SharedMemory(name=self.shm_name)
+        if self.shm.size < np.prod(shape) * np.dtype(np.float32).itemsize:
+            raise ValueError(f'Shared memory {self.shm_name} is too small for {shape}')
+        self.tensors = np.ndarray(shape, dtype=np.float32, buffer=self.shm.buf)
+        self.tensors.flags.writeable = False
+
+    def release(self, unlink=False):
+        """ Detaches from the shared memory segment, and removes it if unlink is set """
+        if self.shm is None:
+            return
+        self.tensors = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # Views of the tensor are still in use, the mapping goes away on exit
+            pass
+        if unlink:
+            self.shm.unlink()
+        self.shm = None
+
+    def position(self, kind, disease, frame):
+        """ Index of a picture in the tensor """
+        offset, count = self.offsets[(kind, disease)]
+        if frame is None or not -count <= frame < count:
+            raise IndexError(f'No frame {frame} for {disease}')
+        return offset + frame % count
+
+    def picture_path(self, kind, disease, frame):
+        """ Path of the original picture """
+        return self.paths[self.position(kind, disease, frame)]
+
+    def get(self, kind, disease, frame):
+        """ Returns a (1,200,200,3) view of the picture, as expected by the inference point """
+        i = self.position(kind, disease, frame)
+        return self.tensors[i:i+1]
+
+    def get_many(self, pictures):
+        """ Returns a (N,200,200,3) batch from a list of (kind, disease, frame) """
+        return self.tensors[[self.position(*picture) for picture in pictures]]
@@ -0,0 +1,56 @@
+""" Prediction cache. Bank pictures never change, so neither does their prediction
+    for a given model version. """
+import time
+from collections import OrderedDict
+
+class PredictionCache:
+    """ LRU cache of predictions keyed by picture and model version, with optional TTL """
+    def __init__(self, max_entries=1024, ttl=0, model_version=''):
+        # max_entries=0 disables the cache, ttl=0 keeps entries until evicted
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.model_version = model_version
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, picture_key):
+        """ Returns the cached prediction, or None """
+        key = (self.model_version, picture_key)
+        entry = self.entries.get(key)
+        if entry is not None and self.ttl and time.monotonic() - entry[0] > self.ttl:
+            del self.entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, picture_key, prediction):
+        """ Stores a prediction, evicting the least recently used one if full """
+        if self.max_entries <= 0:
+            return
+        key = (self.model_version, picture_key)
+        self.entries[key] = (time.monotonic(), prediction)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, model_version=None):
+        """ Drops all predictions, typically when the model is redeployed """
+        self.entries.clear()
+        if model_version is not None:
+            self.model_version = model_version
+
+    def stats(self):
+        """ Hit/miss counters """
+        return {
+            'model_version': self.model_version,
+            'entries': len(self.entries),
+            'max_entries': self.max_entries,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses
+        }
@@ -0,0 +1,93 @@
+""" Decoding of uploaded pictures off the event loop, in a thread pool or a process pool.
+    Process pool workers write the decoded pictures in shared memory slots, so only
+    the compressed picture is sent to them and nothing is pickled back. """
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import metrics
+from preprocessing import IMAGE_SIZE, decode_upload
+
+PICTURE_SHAPE = (*IMAGE_SIZE, 3)
+
+# Result slots, as seen from a process pool worker
+# (the segment is kept referenced, or it would be unmapped under the array)
+worker_shm = None
+worker_slots = None
+
+def init_worker(shm_name, nb_slots):
+    """ Attaches a process pool worker to the result slots """
+    global worker_shm, worker_slots # pylint: disable=global-statement
+    worker_shm = shared_memory.SharedMemory(name=shm_name)
+    worker_slots = np.ndarray((nb_slots, *PICTURE_SHAPE), dtype=np.float32, \
+        buffer=worker_shm.buf)
+
+def decode_into_slot(data, slot):
+    """ Decodes a picture in a process pool worker, into a result slot """
+    worker_slots[slot] = decode_upload(data)
+
+class PreprocessPool:
+    """ Runs picture decoding inline ('none'), in threads ('thread') or in
+        processes ('process'), with at most max_pending pictures in flight """
+    def __init__(self, mode='none', workers=0, max_pending=0):
+        self.mode = mode
+        # 0 uses one worker per CPU, and two pictures in flight per worker
+        self.workers = workers or os.cpu_count()
+        self.max_pending = max_pending or 2 * self.workers
+        self.executor = None
+        self.shm = None
+        self.slots = None
+        self.free_slots = None
+
+    def start(self):
+        """ Starts the pool, must be called from the event loop """
+        self.free_slots = asyncio.Queue()
+        for slot in range(self.max_pending):
+            self.free_slots.put_nowait(slot)
+        if self.mode == 'thread':
+            self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='preprocess')
+        elif self.mode == 'process':
+            shape = (self.max_pending, *PICTURE_SHAPE)
+            self.shm = shared_memory.SharedMemory(create=True, \
+                size=int(np.prod(shape)) * np.dtype(np.float32).itemsize)
+            self.slots = np.ndarray(shape, dtype=np.float32, buffer=self.shm.buf)
+            self.executor = ProcessPoolExecutor(self.workers, initializer=init_worker, \
+                initargs=(self.shm.name, self.max_pending))
+        print(f'Preprocessing: {self.mode}' + \
+            (f', {self.workers} workers' if self.executor else ''))
+
+    def stop(self):
+        """ Stops the pool and removes the result slots """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.shm is not None:
+            self.slots = None
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+    @asynccontextmanager
+    async def decode_upload(self, data):
+        """ Decodes an uploaded picture to a (200,200,3) float32 array, waiting for
+            room if max_pending pictures are in flight. The array may be a view of a
+            shared slot: it is only valid inside the block. """
+        with metrics.stage('decode_wait'):
+            slot = await self.free_slots.get()
+        try:
+            loop = asyncio.get_running_loop()
+            with metrics.stage('decode'):
+                if self.mode == 'process':
+                    await loop.run_in_executor(self.executor, decode_into_slot, data, slot)
+                    img = self.slots[slot]
+                elif self.mode == 'thread':
+                    img = await loop.run_in_executor(self.executor, decode_upload, data)
+                else:
+                    img = decode_upload(data)
+            yield img
+        finally:
+            self.free_slots.put_nowait(slot)
@@ -0,0 +1,43 @@
+""" Picture preprocessing with Pillow and NumPy.
+    Produces the same tensors as tensorflow.keras.utils load_img + img_to_array,
+    without loading TensorFlow in the classification service. """
+import io
+import os
+
+import numpy as np
+from PIL import Image
+
+# Size expected by the model (height, width)
+IMAGE_SIZE = (200, 200)
+
+def load_picture(picture, target_size=IMAGE_SIZE, draft=False):
+    """ Opens a picture (path or file object) as an RGB image resized to target_size,
+        like load_img: nearest neighbour resampling, no aspect ratio preservation.
+        With draft, JPEG pictures are decoded directly at a reduced scale (1/2 to 1/8)
+        still larger than target_size, which is much faster for large pictures. """
+    if isinstance(picture, (str, bytes, os.PathLike)):
+        with open(picture, 'rb') as picture_file:
+            picture = io.BytesIO(picture_file.read())
+    img = Image.open(picture)
+    if draft:
+        # No effect on formats other than JPEG
+        img.draft('RGB', (target_size[1], target_size[0]))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    width_height_tuple = (target_size[1], target_size[0])
+    if img.size != width_height_tuple:
+        img = img.resize(width_height_tuple, Image.NEAREST)
+    return img
+
+def picture_to_array(img):
+    """ (height,width,3) float32 array, like img_to_array """
+    return np.asarray(img, dtype=np.float32)
+
+def decode_picture(picture, target_size=IMAGE_SIZE):
+    """ Decodes and resizes a picture to a (200,200,3) float32 array """
+    return picture_to_array(load_picture(picture, target_size))
+
+def decode_upload(data, target_size=IMAGE_SIZE):
+    """ Decodes an uploaded picture held in memory to a (200,200,3) float32 array,
+        using reduced-scale decoding as camera frames are much larger than needed """
+    return picture_to_array(load_picture(io.BytesIO(data), target_size, draft=True))
@@ -0,0 +1,195 @@
+""" Static frontend serving: precompressed text assets (gzip, brotli), strong ETags,
+    long-lived caching of hashed assets and byte range requests.
+    Run as a script to precompress a folder: python static_assets.py public """
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import sys
+
+import anyio
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response, StreamingResponse
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+
+# Text assets worth compressing, by extension
+COMPRESSIBLE_EXTENSIONS = {'.css', '.fnt', '.html', '.js', '.json', '.map', '.mjs', '.otf', \
+    '.svg', '.ttf', '.txt', '.wasm', '.xml'}
+# Smaller files are sent as they are
+MIN_COMPRESS_SIZE = 1024
+# Precompressed variants, preferred first: (content encoding, file suffix)
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+# Assets with a content hash in their name (e.g. main.3f2a9c1b.js) never change
+HASHED_NAME = re.compile(r'[.-][0-9a-f]{8,}\.[^/]+$')
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+# Single byte range, other range requests get the whole file
+BYTE_RANGE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+def compressible(path):
+    """ True for text assets """
+    return os.path.splitext(path)[1].lower() in COMPRESSIBLE_EXTENSIONS
+
+def precompress(directory, min_size=MIN_COMPRESS_SIZE):
+    """ Writes .br and .gz variants next to each text asset, when they are smaller.
+        Variants newer than their asset are kept. Returns the number of files written. """
+    try:
+        # Optional dependency, gzip variants only without it
+        import brotli # pylint: disable=import-outside-toplevel
+    except ImportError:
+        brotli = None
+        print('brotli not installed, only gzip variants are written')
+    written = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            path = os.path.join(root, name)
+            if not compressible(path) or os.path.getsize(path) < min_size:
+                continue
+            data = None
+            for encoding, suffix in ENCODINGS:
+                if encoding == 'br' and brotli is None:
+                    continue
+                target = path + suffix
+                if os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(path):
+                    continue
+                if data is None:
+                    with open(path, 'rb') as asset_file:
+                        data = asset_file.read()
+                if encoding == 'br':
+                    compressed = brotli.compress(data, quality=11)
+                else:
+                    compressed = gzip.compress(data, compresslevel=9, mtime=0)
+                try:
+                    if len(compressed) < len(data):
+                        # Written aside then renamed: concurrent workers never serve a partial
+                        # variant, nor interleave their writes in the same file
+                        tmp_target = f'{target}.{os.getpid()}.tmp'
+                        with open(tmp_target, 'wb') as target_file:
+                            target_file.write(compressed)
+                        os.replace(tmp_target, target)
+                        written += 1
+                    elif os.path.exists(target):
+                        os.remove(target)
+                except OSError as ex:
+                    # e.g. read-only folder, the precompressed variants from the build are used
+                    print(f'{target} not written: {ex}')
+    return written
+
+def accepted_encodings(accept_encoding):
+    """ Encodings accepted in an Accept-Encoding header, except those with q=0 """
+    accepted = set()
+    for item in accept_encoding.split(','):
+        encoding, *params = [part.strip() for part in item.split(';')]
+        if not any(param.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000') \
+            for param in params):
+            accepted.add(encoding.lower())
+    return accepted
+
+async def read_range(path, start, length, chunk_size=64 * 1024):
+    """ Streams length bytes of a file from start """
+    async with await anyio.open_file(path, 'rb') as range_file:
+        await range_file.seek(start)
+        while length > 0:
+            chunk = await range_file.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+class CompressedStaticFiles(StaticFiles):
+    """ StaticFiles sending the precompressed variant accepted by the client,
+        with content hash ETags, cache headers and single byte range requests """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Content hash of served files, by (path, modification time, size)
+        self.etags = dict()
+
+    def etag(self, path, stat_result):
+        """ Strong ETag: hash of the content, so it is the same on every replica """
+        key = (path, stat_result.st_mtime_ns, stat_result.st_size)
+        if key not in self.etags:
+            digest = hashlib.sha1()
+            with open(path, 'rb') as asset_file:
+                for chunk in iter(lambda: asset_file.read(1024 * 1024), b''):
+                    digest.update(chunk)
+            self.etags[key] = f'"{digest.hexdigest()}"'
+        return self.etags[key]
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        request_headers = Headers(scope=scope)
+        full_path = os.fspath(full_path)
+        path, encoding = full_path, None
+        # Ranges are served from the uncompressed file
+        if compressible(full_path) and 'range' not in request_headers:
+            accepted = accepted_encodings(request_headers.get('accept-encoding', ''))
+            for candidate, suffix in ENCODINGS:
+                if candidate in accepted and os.path.isfile(full_path + suffix):
+                    path, encoding = full_path + suffix, candidate
+                    stat_result = os.stat(path)
+                    break
+
+        # Content type comes from the original name, not from the .br/.gz one
+        media_type = mimetypes.guess_type(full_path)[0] or 'text/plain'
+        response = FileResponse(path, status_code=status_code, stat_result=stat_result, \
+            method=scope['method'], media_type=media_type)
+        response.headers['etag'] = self.etag(path, stat_result)
+        response.headers['cache-control'] = IMMUTABLE if HASHED_NAME.search(full_path) \
+            else REVALIDATE
+        response.headers['accept-ranges'] = 'bytes'
+        if compressible(full_path):
+            response.headers['vary'] = 'Accept-Encoding'
+        if encoding:
+            response.headers['content-encoding'] = encoding
+
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        if status_code == 200 and 'range' in request_headers:
+            return self.range_response(path, stat_result, response, request_headers, \
+                scope['method']) or response
+        return response
+
+    def is_not_modified(self, response_headers, request_headers):
+        """ If-None-Match may list several ETags, weak or not """
+        if_none_match = request_headers.get('if-none-match')
+        if if_none_match:
+            tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+            return response_headers['etag'] in tags or '*' in tags
+        return super().is_not_modified(response_headers, request_headers)
+
+    @staticmethod
+    def range_response(path, stat_result, response, request_headers, method):
+        """ 206 response for a single byte range, None to send the whole file """
+        if_range = request_headers.get('if-range')
+        if if_range and if_range not in (response.headers['etag'], \
+            response.headers['last-modified']):
+            return None
+        match = BYTE_RANGE.match(request_headers['range'].replace(' ', ''))
+        if match is None:
+            return None
+        size = stat_result.st_size
+        first, last = match.groups()
+        if first:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        elif last:
+            start = max(0, size - int(last))
+            end = size - 1
+        else:
+            return None
+        if start > end:
+            return Response(status_code=416, headers={'content-range': f'bytes */{size}'})
+
+        headers = {name: response.headers[name] for name in \
+            ('etag', 'last-modified', 'cache-control', 'accept-ranges') \
+            if name in response.headers}
+        headers['content-range'] = f'bytes {start}-{end}/{size}'
+        headers['content-length'] = str(end - start + 1)
+        if method == 'HEAD':
+            return Response(status_code=206, headers=headers, media_type=response.media_type)
+        return StreamingResponse(read_range(path, start, end - start + 1), status_code=206, \
+            headers=headers, media_type=response.media_type)
+
+if __name__ == "__main__":
+    for folder in sys.argv[1:] or ['public']:
+        print(f'{precompress(folder)} precompressed files written in {folder}')
@@ -0,0 +1,51 @@
+""" Checks the Pillow/NumPy preprocessing against the TensorFlow pipeline it replaces
+    (load_img + img_to_array). Skipped when TensorFlow is not installed, as in the image.
+    Run with: python -m pytest test_preprocessing.py """
+import glob
+import io
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from preprocessing import IMAGE_SIZE, decode_picture
+
+keras_utils = pytest.importorskip('tensorflow.keras.utils')
+
+PICTURES = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), \
+    'assets', 'pictures', '*', '*')))
+
+def tensorflow_decode(picture):
+    """ Picture decoded as the classification service did with TensorFlow """
+    return keras_utils.img_to_array(keras_utils.load_img(picture, target_size=IMAGE_SIZE))
+
+def test_bank_pictures_found():
+    """ The comparison below runs on the picture bank """
+    assert PICTURES
+
+@pytest.mark.parametrize('picture', PICTURES, ids=os.path.basename)
+def test_bank_picture_identical(picture):
+    """ Bank pictures decode to the same float32 tensors, bit for bit """
+    expected = tensorflow_decode(picture)
+    result = decode_picture(picture)
+    assert result.dtype == expected.dtype
+    assert result.shape == expected.shape
+    np.testing.assert_array_equal(result, expected)
+
+@pytest.mark.parametrize('mode,size,image_format', [
+    ('RGBA', (317, 241), 'PNG'),
+    ('L', (120, 80), 'PNG'),
+    ('P', (640, 480), 'GIF'),
+    ('RGB', (200, 200), 'JPEG'),
+    ('RGB', (1024, 768), 'JPEG'),
+])
+def test_other_pictures_identical(tmp_path, mode, size, image_format):
+    """ Other modes and sizes, including no resize and upscaling """
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).convert(mode).save(buffer, image_format)
+    picture = tmp_path / f'picture.{image_format.lower()}'
+    picture.write_bytes(buffer.getvalue())
+    np.testing.assert_array_equal(decode_picture(str(picture)), tensorflow_decode(str(picture)))
@@ -1,19 +1,44 @@
 """ Path and Route services API """
+import asyncio
+import json
 import os
 import uuid
 
 from dotenv import load_dotenv
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from uvicorn import run
 from extremitypathfinder import PolygonEnvironment
 
 import pathfinder
 import route_solver
+from barn_distances import BarnDistances
+from route_jobs import RouteJobs
 
 # Load local env vars if present
 load_dotenv()
+# Shortest paths cache, shared by all requests: max entries and approximate max memory
+PATH_CACHE_SIZE = int(os.getenv('PATH_CACHE_SIZE', '100000'))
+PATH_CACHE_MAX_MB = float(os.getenv('PATH_CACHE_MAX_MB', '64'))
+# Distance rasters from the barns: enabled, folder of the memory-mapped files, cell size
+# (map units) and exact lengths for fields instead of the value of their cell
+BARN_DISTANCES = os.getenv('BARN_DISTANCES', 'true').lower() == 'true'
+BARN_DISTANCES_DIR = os.getenv('BARN_DISTANCES_DIR', './barn_distances')
+BARN_DISTANCES_RESOLUTION = int(os.getenv('BARN_DISTANCES_RESOLUTION', '10'))
+BARN_DISTANCES_EXACT = os.getenv('BARN_DISTANCES_EXACT', 'false').lower() == 'true'
+# Solving time limit of the small route problems solved at startup to warm up the JVM
+# (seconds, 0 to skip)
+ROUTE_WARM_UP_SECONDS = float(os.getenv('ROUTE_WARM_UP_SECONDS', '2'))
+# Route solver used when a request does not ask for one: optapy or numpy
+ROUTE_SOLVER = os.getenv('ROUTE_SOLVER', 'optapy')
+# Route jobs: solving threads, max jobs queued or solving, finished jobs kept, and
+# min interval between the improving routes published while solving (seconds)
+ROUTE_JOB_WORKERS = int(os.getenv('ROUTE_JOB_WORKERS', '2'))
+ROUTE_JOB_MAX_PENDING = int(os.getenv('ROUTE_JOB_MAX_PENDING', '8'))
+ROUTE_JOB_HISTORY = int(os.getenv('ROUTE_JOB_HISTORY', '100'))
+ROUTE_JOB_PUBLISH_INTERVAL = float(os.getenv('ROUTE_JOB_PUBLISH_INTERVAL', '0.5'))
 
 # App creation
 app = FastAPI()
@@ -76,6 +101,8 @@ class RouteFinderEntry(BaseModel): # Tractor asks for full Route
     kind: str = ""
     start_coordinates: tuple[float,float] = None
     uuid: str = ""
+    solver: str = "" # optapy or numpy, ROUTE_SOLVER if empty
+    encoding: str = "" # delta for a compact route_deltas result instead of route
 
     class Config:
         """ Example """
@@ -83,13 +110,16 @@ class RouteFinderEntry(BaseModel): # Tractor asks for full Route
             "example": {
                 "kind": "wheat",
                 "start_coordinates": (715,822),
-                "uuid": "c303282d-f2e6-46ca-a04a-35d3d873712d"
+                "uuid": "c303282d-f2e6-46ca-a04a-35d3d873712d",
+                "solver": "numpy"
             }
         }
 
 class RouteFinderResult(BaseModel):
     """ Route query result """
     route: list[tuple[float,float]] = None # List of coordinates to got to
+    # With delta encoding: whole units, [x0, y0, x1 - x0, y1 - y0, ...]
+    route_deltas: list[int] = None
 
     class Config:
         """ Example """
@@ -141,6 +171,22 @@ class DestinationEntry(BaseModel):
             }
         }
 
+class DestinationsEntry(BaseModel):
+    """ Additional destination entries """
+    kind: str = ""
+    coordinates: list[tuple[float,float]] = []
+    uuid: str = ""
+
+    class Config:
+        """ Example """
+        schema_extra = {
+            "example": {
+                "kind": "wheat",
+                "coordinates": [(10.0,22.1), (20.5, 400.0)],
+                "uuid": "c303282d-f2e6-46ca-a04a-35d3d873712d"
+            }
+        }
+
 # Initialize destinations dict
 destinations = dict()
 
@@ -200,22 +246,93 @@ async def pathfinder_api(entry: PathFinderEntry):
     return response
 
 # Route API
+# Route encodings a request can ask for: coordinates, or delta-encoded integers
+ROUTE_ENCODINGS = ('', 'delta')
+
+async def submit_route_job(entry: RouteFinderEntry, wait=False):
+    """ Queues a route job for the destinations of a uuid and kind of crop. When too
+        many jobs are pending, waits for one to finish if wait is set, else 503 """
+    solver = entry.solver or ROUTE_SOLVER
+    if solver not in route_solver.SOLVERS:
+        raise HTTPException(status_code=400, detail=f'Unknown solver: {solver}')
+    if wait:
+        await route_jobs.slot()
+    # destinations entries will be translated in the router module
+    job = route_jobs.submit(entry.kind, solver, destinations[entry.uuid][entry.kind])
+    if job is None:
+        raise HTTPException(status_code=503, detail='Too many route jobs in progress')
+    return job
+
+def get_route_job(job_id):
+    """ Returns a route job, 404 if unknown """
+    job = route_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f'Unknown route job: {job_id}')
+    return job
+
 @app.post("/routefinder", response_model = RouteFinderResult)
-async def routefinder(entry: RouteFinderEntry):
+async def routefinder(entry: RouteFinderEntry, response: Response):
     """ Finds route going through all destinations """
+    if entry.encoding not in ROUTE_ENCODINGS:
+        raise HTTPException(status_code=400, detail=f'Unknown encoding: {entry.encoding}')
+    # Tractors do not handle errors: the request waits for its turn instead of a 503
+    job = await submit_route_job(entry, wait=True)
+    # The client may leave, the job still finishes
+    state = await asyncio.shield(job.finished)
+    if state['status'] == 'failed':
+        raise HTTPException(status_code=500, detail=state['error'])
+
+    if job.timings:
+        # Setup (distances, solver creation) versus solving time
+        timings = job.timings
+        setup = timings['problem'] + timings.get('solver_setup', 0)
+        print(f'Route {entry.kind} ({job.solver}), ' \
+            f'{len(destinations[entry.uuid][entry.kind])} destinations: ' \
+            f'setup {setup * 1000:.0f} ms (distances {timings["problem"] * 1000:.0f} ms, ' \
+            f'solver {timings.get("solver_setup", 0) * 1000:.0f} ms), ' \
+            f'solving {timings["solving"] * 1000:.0f} ms, path {timings["path"] * 1000:.0f} ms')
+        response.headers['Server-Timing'] = ', '.join(f'{name};dur={elapsed * 1000:.2f}' \
+            for name, elapsed in timings.items())
+
+    # Path has already been translated back in the router module
     result = RouteFinderResult()
-    if(destinations[entry.uuid][entry.kind]) != []:
-        # destinations entries will be translated in the router module
-        route = route_solver.routefinder(pathfinder_environment, \
-            entry.kind,destinations[entry.uuid][entry.kind])
-
-        # Path has already been translated back in the router module
-        result.route = route
+    if entry.encoding == 'delta':
+        result.route_deltas = pathfinder.encode_route(state['route'])
     else:
-        result.route = [(-1,-1)]
-
+        result.route = state['route']
     return result
 
+# Route jobs API
+@app.post("/routejobs")
+async def create_route_job(entry: RouteFinderEntry):
+    """ Starts solving a route, returns the job state with its id """
+    return (await submit_route_job(entry)).state()
+
+@app.get("/routejobs/{job_id}")
+async def get_route_job_state(job_id: str):
+    """ Job status, and best route so far """
+    return get_route_job(job_id).state()
+
+@app.delete("/routejobs/{job_id}")
+async def cancel_route_job(job_id: str):
+    """ Stops solving, the best route so far becomes the result """
+    job = get_route_job(job_id)
+    route_jobs.cancel(job)
+    return job.state()
+
+@app.get("/routejobs/{job_id}/events")
+async def route_job_events(job_id: str):
+    """ Server-Sent Events stream of the job states: each better route while solving,
+        until the job is done, cancelled or failed """
+    job = get_route_job(job_id)
+
+    async def events():
+        async for state in job.updates():
+            yield f'event: {state["status"]}\ndata: {json.dumps(state)}\n\n'
+
+    return StreamingResponse(events(), media_type='text/event-stream', \
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 # Destination arrays API
 @app.post("/alldestinations", response_model = DestinationsResult)
 async def get_destinations(entry: DestinationsQuery):
@@ -237,6 +354,13 @@ async def add_destination_entry(entry: DestinationEntry):
     print(destinations[entry.uuid][entry.kind])
     return True
 
+@app.put("/destinations")
+async def add_destination_entries(entry: DestinationsEntry):
+    """ Adds several destinations in the array for a kind of crop and uuid"""
+    destinations[entry.uuid][entry.kind].extend(entry.coordinates)
+    print(destinations[entry.uuid][entry.kind])
+    return True
+
 @app.delete("/destination")
 async def delete_destination_entry(entry: DestinationEntry):
     """ Removes a destination from an array for a kind of crop and uuid"""
@@ -248,9 +372,41 @@ async def delete_destination_entry(entry: DestinationEntry):
 
     return True
 
+# Path cache API
+@app.get("/cache")
+async def get_cache_stats():
+    """ Path cache hits, misses and size """
+    return pathfinder.path_cache.stats()
+
+@app.delete("/cache")
+async def clear_cache():
+    """ Empties the path cache """
+    pathfinder.path_cache.clear()
+    return True
+
+@app.on_event("startup")
+async def start_route_jobs():
+    """ Starts the route solving threads """
+    route_jobs.start()
+
+@app.on_event("shutdown")
+async def stop_route_jobs():
+    """ Cancels the route jobs """
+    route_jobs.stop()
+
 # Initialize PathFinder
 pathfinder_environment = PolygonEnvironment()
 pathfinder.initialize_environment(pathfinder_environment)
+pathfinder.path_cache.set_limits(PATH_CACHE_SIZE, int(PATH_CACHE_MAX_MB * 1024 * 1024))
+if BARN_DISTANCES:
+    pathfinder.barn_distances = BarnDistances(BARN_DISTANCES_DIR, \
+        BARN_DISTANCES_RESOLUTION, BARN_DISTANCES_EXACT)
+    pathfinder.barn_distances.load(pathfinder_environment)
+# Solver factory and JVM warm-up, before the first tractor asks for a route
+if ROUTE_WARM_UP_SECONDS > 0:
+    route_solver.warm_up(pathfinder_environment, ROUTE_WARM_UP_SECONDS)
+route_jobs = RouteJobs(pathfinder_environment, ROUTE_JOB_WORKERS, ROUTE_JOB_MAX_PENDING, \
+    ROUTE_JOB_HISTORY, ROUTE_JOB_PUBLISH_INTERVAL)
 
 # Launch the FastAPI server
 if __name__ == "__main__":
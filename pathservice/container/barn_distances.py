@@ -0,0 +1,217 @@
+""" Distance rasters from each barn over the whole map, computed once and memory-mapped.
+    Barn-to-field distances become lookups instead of visibility graph searches.
+    Run as a script to compute them offline: python barn_distances.py """
+import hashlib
+import json
+import math
+import os
+
+import numpy as np
+from extremitypathfinder import PolygonEnvironment
+
+import map_definition
+import pathfinder
+from distance_matrix import location_visibility, shortest_lengths
+
+# Raster cells processed at once, bounds the memory used by the visibility tests
+CHUNK_SIZE = 256
+# Part of the raster key, bumped when the way rasters are computed changes
+RASTER_VERSION = 2
+
+def cross(origin, first, second):
+    """ z component of (first - origin) x (second - origin), broadcast """
+    return (first[..., 0] - origin[..., 0]) * (second[..., 1] - origin[..., 1]) - \
+        (first[..., 1] - origin[..., 1]) * (second[..., 0] - origin[..., 0])
+
+def visibility(points, targets, edges):
+    """ (n,k) mask of the targets visible from each point: no polygon edge crosses the
+        segment between them. Edges touching the segment at the target do not block it,
+        edges touching it elsewhere do. """
+    start = points[:, None, None, :]
+    end = targets[None, :, None, :]
+    edge_start = edges[None, None, :, 0, :]
+    edge_end = edges[None, None, :, 1, :]
+    blocked = (cross(start, end, edge_start) * cross(start, end, edge_end) <= 0) & \
+        (cross(edge_start, edge_end, start) * cross(edge_start, edge_end, end) < 0)
+    return ~blocked.any(axis=2)
+
+def on_edges(points, edges):
+    """ Mask of the points lying on a polygon edge, vertices included """
+    start = edges[None, :, 0, :]
+    end = edges[None, :, 1, :]
+    point = points[:, None, :]
+    collinear = cross(start, end, point) == 0
+    between = (np.minimum(start, end) <= point).all(axis=2) & \
+        (point <= np.maximum(start, end)).all(axis=2)
+    return (collinear & between).any(axis=1)
+
+def inside(points, polygon):
+    """ Mask of the points inside a polygon (even-odd rule), points on its edges may
+        count as inside or outside """
+    result = np.zeros(len(points), dtype=bool)
+    x, y = points[:, 0], points[:, 1]
+    for (x1, y1), (x2, y2) in zip(polygon, np.roll(polygon, -1, axis=0)):
+        if y1 == y2:
+            continue
+        crosses = (y1 > y) != (y2 > y)
+        x_cross = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+        result ^= crosses & (x < x_cross)
+    return result
+
+class BarnDistances:
+    """ For each barn, an (ny,nx) float32 raster of shortest path lengths from the barn
+        to the center of each cell of `resolution` map units, inf outside the map """
+    def __init__(self, directory='./barn_distances', resolution=10, exact=False):
+        self.directory = directory
+        self.resolution = resolution
+        # Exact lengths for the given points instead of the value of their cell
+        self.exact = exact
+        self.rasters = dict()
+        self.node_lengths = dict()
+
+    def shape(self):
+        """ Raster size (rows, columns) """
+        return (math.ceil(map_definition.MAP_HEIGHT / self.resolution), \
+            math.ceil(map_definition.MAP_WIDTH / self.resolution))
+
+    def cell_centers(self):
+        """ (ny*nx,2) centers of the raster cells, in PathFinder coordinates """
+        rows, columns = self.shape()
+        y, x = np.mgrid[0:rows, 0:columns]
+        return np.stack([(x.ravel() + 0.5) * self.resolution, \
+            (y.ravel() + 0.5) * self.resolution], axis=1)
+
+    def key(self, location):
+        """ Describes what a raster was computed from """
+        description = json.dumps([map_definition.boundary_coordinates, \
+            map_definition.list_of_obstacles, list(location), self.resolution, \
+            map_definition.MAP_WIDTH, map_definition.MAP_HEIGHT, RASTER_VERSION])
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def raster_path(self, name):
+        """ Raster file of a barn """
+        return os.path.join(self.directory, f'{name}_{self.resolution}.npy')
+
+    def load(self, pathfinder_environment):
+        """ Maps the raster of each barn from its file, computing it if missing or stale """
+        for barn in map_definition.barns:
+            location = pathfinder.translate_coordinates(barn['location'])
+            lengths = self.lengths_from(pathfinder_environment, location)
+            self.node_lengths[location] = lengths
+            raster = self.load_raster(barn['name'], location)
+            if raster is None:
+                raster = self.compute(pathfinder_environment, location, lengths)
+                raster = self.save_raster(barn['name'], location, raster)
+            self.rasters[location] = raster
+        print(f'Barn distances ready ({len(self.rasters)} barns, resolution {self.resolution})')
+
+    def load_raster(self, name, location):
+        """ Memory-maps a raster file, returns None if missing or stale """
+        path = self.raster_path(name)
+        try:
+            with open(os.path.splitext(path)[0] + '.json', encoding='utf-8') as key_file:
+                if json.load(key_file) != self.key(location):
+                    return None
+            raster = np.load(path, mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        return raster if raster.shape == self.shape() else None
+
+    def save_raster(self, name, location, raster):
+        """ Writes a raster and its key, then maps it back read-only """
+        path = self.raster_path(name)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            np.save(path, raster)
+            with open(os.path.splitext(path)[0] + '.json', 'w', encoding='utf-8') as key_file:
+                json.dump(self.key(location), key_file)
+        except OSError as ex:
+            print(f'Barn distances not saved: {ex}')
+            return raster
+        return np.load(path, mmap_mode='r')
+
+    @staticmethod
+    def lengths_from(pathfinder_environment, location):
+        """ Shortest path lengths from a location to every visibility graph node """
+        graph_nodes = list(pathfinder_environment.graph.nodes)
+        links, _ = location_visibility(pathfinder_environment, location, [], graph_nodes)
+        graph = pathfinder_environment.graph.copy()
+        source = pathfinder_environment.nr_vertices
+        for node, length in links.items():
+            graph.add_edge(source, node, weight=length)
+        return shortest_lengths(graph, source, graph_nodes)
+
+    def compute(self, pathfinder_environment, location, lengths):
+        """ Raster of shortest path lengths from a location: for each cell center, the
+            shortest of (length to a visible graph node + straight line from it) """
+        nodes = list(lengths)
+        targets = np.array([location] + [pathfinder_environment.coords[node] \
+            for node in nodes], dtype=float)
+        target_lengths = np.array([0.0] + [lengths[node] for node in nodes])
+        edges = pathfinder_environment.coords[pathfinder_environment.edge_vertex_idxs]
+
+        centers = self.cell_centers()
+        within = inside(centers, pathfinder_environment.boundary_polygon)
+        for hole in pathfinder_environment.holes:
+            within &= ~inside(centers, hole)
+        # Centers on an edge are rejected by PathFinder and the visibility tests along the
+        # edge do not hold for them, their cells fall back to exact lengths
+        within &= ~on_edges(centers, edges)
+
+        raster = np.full(len(centers), np.inf, dtype=np.float32)
+        for first in range(0, len(centers), CHUNK_SIZE):
+            points = centers[first:first + CHUNK_SIZE]
+            visible = visibility(points, targets, edges)
+            totals = np.linalg.norm(points[:, None, :] - targets[None, :, :], axis=2) + \
+                target_lengths[None, :]
+            raster[first:first + CHUNK_SIZE] = np.where(visible, totals, np.inf).min(axis=1)
+        raster[~within] = np.inf
+        return raster.reshape(self.shape())
+
+    def cell_value(self, location, point):
+        """ Raster value of the cell containing point """
+        rows, columns = self.shape()
+        row = min(max(int(point[1] // self.resolution), 0), rows - 1)
+        column = min(max(int(point[0] // self.resolution), 0), columns - 1)
+        return float(self.rasters[location][row, column])
+
+    def exact_length(self, pathfinder_environment, location, point, path_cache=None):
+        """ Shortest path length from a barn to point, from the graph nodes visible from point """
+        links = None if path_cache is None else path_cache.get_links(point)
+        graph_nodes = list(pathfinder_environment.graph.nodes) if links is None else []
+        new_links, direct = location_visibility(pathfinder_environment, point, [location], \
+            graph_nodes)
+        if links is None:
+            links = new_links
+            if path_cache is not None:
+                path_cache.put_links(point, links)
+        lengths = self.node_lengths[location]
+        return float(min([direct.get(0, np.inf)] + \
+            [length + lengths[node] for node, length in links.items() if node in lengths]))
+
+    def length(self, pathfinder_environment, location, point, path_cache=None):
+        """ Length from a barn location to point, None if location is not a barn """
+        if location not in self.rasters:
+            return None
+        length = np.inf if self.exact else self.cell_value(location, point)
+        # Cells centered outside the map (e.g. points close to an obstacle) have no value
+        if np.isinf(length):
+            length = self.exact_length(pathfinder_environment, location, point, path_cache)
+        return length
+
+    def fill_cache(self, pathfinder_environment, locations, path_cache):
+        """ Stores the lengths between the barns and the other locations in the path cache,
+            where the distance matrix finds them """
+        barns = [location for location in locations if tuple(location) in self.rasters]
+        for barn in barns:
+            for location in locations:
+                if tuple(location) != tuple(barn) and \
+                    path_cache.get_length(barn, location) is None:
+                    path_cache.put_length(barn, location, self.length(pathfinder_environment, \
+                        tuple(barn), tuple(location), path_cache))
+
+if __name__ == "__main__":
+    environment = PolygonEnvironment()
+    pathfinder.initialize_environment(environment)
+    BarnDistances(os.getenv('BARN_DISTANCES_DIR', './barn_distances'), \
+        int(os.getenv('BARN_DISTANCES_RESOLUTION', '10'))).load(environment)
@@ -0,0 +1,153 @@
+""" Shortest path distances between many locations at once, on the prepared
+    visibility graph of a PathFinder environment """
+import heapq
+
+import numpy as np
+from extremitypathfinder.utils import cmp_reps_n_distances
+
+def location_visibility(pathfinder_environment, point, others, graph_nodes):
+    """ Returns the graph nodes visible from point as {node: distance}, and the
+        other points visible from point as {position in others: distance} """
+    base = pathfinder_environment.nr_vertices
+    coords = np.append(pathfinder_environment.coords, \
+        np.array([point, *others], dtype=float), axis=0)
+    vert_idx2repr, vert_idx2dist = cmp_reps_n_distances(base, coords)
+    candidates = set(graph_nodes) | set(range(base + 1, base + 1 + len(others)))
+    visible = pathfinder_environment.get_visible_idxs(base, candidates, coords, \
+        vert_idx2repr, vert_idx2dist)
+    # A point on a graph node is not "visible" from it, it is the same place
+    links = {node: 0.0 for node in graph_nodes if vert_idx2dist[node] == 0.0}
+    links.update({node: vert_idx2dist[node] for node in visible if node < base})
+    direct = {node - base - 1: vert_idx2dist[node] for node in visible if node > base}
+    return links, direct
+
+def shortest_lengths(graph, source, targets, predecessors=None):
+    """ Dijkstra search from source, stopped once all targets are reached. If given,
+        predecessors is filled with the previous node of each node on its shortest path """
+    remaining = set(targets)
+    remaining.discard(source)
+    lengths = {source: 0.0}
+    settled = set()
+    queue = [(0.0, source)]
+    while queue and remaining:
+        length, node = heapq.heappop(queue)
+        if node in settled:
+            continue
+        settled.add(node)
+        remaining.discard(node)
+        for neighbour, edge in graph.adj[node].items():
+            new_length = length + edge['weight']
+            if neighbour not in settled and new_length < lengths.get(neighbour, np.inf):
+                lengths[neighbour] = new_length
+                if predecessors is not None:
+                    predecessors[neighbour] = node
+                heapq.heappush(queue, (new_length, neighbour))
+    return {target: lengths[target] for target in targets if target in settled or target == source}
+
+class LegPaths:
+    """ Shortest paths between the locations of distance matrices, rebuilt on demand
+        from the search trees of the matrix computation """
+    def __init__(self):
+        # Search tree from each start: predecessors, goal nodes by coordinates and
+        # coordinates of a node
+        self.searches = dict()
+
+    def add(self, start, predecessors, goals, node_coordinates):
+        """ Keeps the search tree from start """
+        self.searches[tuple(start)] = (predecessors, goals, node_coordinates)
+
+    def get(self, start, goal):
+        """ Shortest path from start to goal as a list of coordinates,
+            None if it was not searched """
+        start, goal = tuple(start), tuple(goal)
+        if start == goal:
+            return [start, goal]
+        for first, second in ((start, goal), (goal, start)):
+            search = self.searches.get(first)
+            if search is not None and second in search[1]:
+                predecessors, goals, node_coordinates = search
+                nodes = [goals[second]]
+                while nodes[-1] in predecessors:
+                    nodes.append(predecessors[nodes[-1]])
+                path = [node_coordinates(node) for node in nodes]
+                # Built from the goal of the search back to its start
+                return path[::-1] if first == start else path
+        return None
+
+def distance_matrix(pathfinder_environment, locations, path_cache=None, leg_paths=None):
+    """ Symmetric (n,n) array of the shortest path lengths between n locations (PathFinder
+        coordinates), np.inf if there is no path. One search per location, each one only
+        towards the locations after it. With a path cache, only the pairs it does not
+        know are searched, and the visibility of known locations is reused. With
+        leg_paths (LegPaths), the paths of the searched pairs can be rebuilt later. """
+    for coordinates in locations:
+        if not pathfinder_environment.within_map(np.array(coordinates, dtype=float)):
+            raise ValueError(f'{coordinates} does not lie within the map')
+
+    # Identical locations share one node
+    unique_locations = list(dict.fromkeys(tuple(coordinates) for coordinates in locations))
+    unique_distances = np.zeros((len(unique_locations), len(unique_locations)))
+    missing = dict()
+    for i, start in enumerate(unique_locations):
+        for j in range(i + 1, len(unique_locations)):
+            length = None if path_cache is None \
+                else path_cache.get_length(start, unique_locations[j])
+            if length is None:
+                missing.setdefault(i, []).append(j)
+            else:
+                unique_distances[i, j] = unique_distances[j, i] = length
+
+    if missing:
+        # Locations are added to a copy of the visibility graph, numbered after its vertices
+        base = pathfinder_environment.nr_vertices
+        graph = pathfinder_environment.graph.copy()
+        graph_nodes = list(pathfinder_environment.graph.nodes)
+        involved = set(missing).union(*missing.values())
+        links = {i: None if path_cache is None else path_cache.get_links(unique_locations[i]) \
+            for i in involved}
+        # Direct visibility of a missing pair is checked once, from the location whose
+        # visibility has to be computed anyway if there is one
+        checks = dict()
+        for i, partners in missing.items():
+            for j in partners:
+                if links[i] is not None and links[j] is None:
+                    checks.setdefault(j, []).append(i)
+                else:
+                    checks.setdefault(i, []).append(j)
+        for i in sorted(involved):
+            others = checks.get(i, [])
+            if links[i] is None or others:
+                new_links, direct = location_visibility(pathfinder_environment, \
+                    unique_locations[i], [unique_locations[j] for j in others], \
+                    graph_nodes if links[i] is None else [])
+                if links[i] is None:
+                    links[i] = new_links
+                    if path_cache is not None:
+                        path_cache.put_links(unique_locations[i], new_links)
+                for position, length in direct.items():
+                    graph.add_edge(base + i, base + others[position], weight=length)
+            for node, length in links[i].items():
+                graph.add_edge(base + i, node, weight=length)
+
+        def node_coordinates(node):
+            """ Coordinates of a graph node or of a location """
+            if node >= base:
+                return unique_locations[node - base]
+            return tuple(float(value) for value in pathfinder_environment.coords[node])
+
+        for i, partners in missing.items():
+            predecessors = None if leg_paths is None else dict()
+            lengths = shortest_lengths(graph, base + i, [base + j for j in partners], \
+                predecessors)
+            if leg_paths is not None:
+                leg_paths.add(unique_locations[i], predecessors, \
+                    {unique_locations[j]: base + j for j in partners}, node_coordinates)
+            for j in partners:
+                unique_distances[i, j] = unique_distances[j, i] = lengths.get(base + j, np.inf)
+                if path_cache is not None:
+                    path_cache.put_length(unique_locations[i], unique_locations[j], \
+                        float(unique_distances[i, j]))
+
+    positions = {coordinates: i for i, coordinates in enumerate(unique_locations)}
+    indexes = [positions[tuple(coordinates)] for coordinates in locations]
+    return unique_distances[np.ix_(indexes, indexes)]
@@ -0,0 +1,343 @@
+""" Tractor routing without the JVM: the constraints of the OptaPy solver on a NumPy
+    distance matrix, solved exactly for a few fields, and by construction plus local
+    search (2-opt, or-opt, exchanges) otherwise """
+import math
+import time
+
+import numpy as np
+
+# Exact search (dynamic programming over the subsets of fields) up to this many fields
+EXACT_MAX_FIELDS = 10
+# Longest segment of fields moved at once by or-opt
+OR_OPT_MAX_LENGTH = 3
+# Smaller improvements are float rounding
+EPSILON = 1e-9
+
+class RoutingProblem:
+    """ Tractor routing on integer indexes: distances between locations, and
+        - for each tractor: its barn (location index), capacity, and if it is virtual
+        - for each field: its location index and demand
+        A route is the list of the fields (indexes in the field list) a tractor visits.
+        Like the OptaPy constraints: capacity overloads are hard penalties, fields visited
+        by virtual tractors are medium ones, and route lengths (plus 1 per tractor) soft ones. """
+    def __init__(self, distances, tractor_barns, capacities, virtual, field_locations, demands):
+        self.distances = np.asarray(distances, dtype=float)
+        self.tractor_barns = np.asarray(tractor_barns, dtype=int)
+        self.capacities = np.asarray(capacities, dtype=float)
+        self.virtual = np.asarray(virtual, dtype=bool)
+        self.field_locations = np.asarray(field_locations, dtype=int)
+        self.demands = np.asarray(demands, dtype=float)
+        # Costs are penalties and lengths in one number: one medium point outweighs the
+        # lengths of all the routes, and one hard point all the medium ones
+        finite = self.distances[np.isfinite(self.distances)]
+        nb_fields, nb_tractors = len(self.field_locations), len(self.tractor_barns)
+        self.medium_weight = math.ceil((nb_fields + nb_tractors + 1) * \
+            (finite.max() if finite.size else 0)) + nb_tractors + 1
+        self.hard_weight = (nb_fields + 1) * self.medium_weight
+
+    def stops(self, tractor, route):
+        """ Location indexes of a route, from and back to the barn """
+        barn = self.tractor_barns[tractor]
+        return np.concatenate(([barn], self.field_locations[route], [barn])).astype(int)
+
+    def length(self, tractor, route):
+        """ Route length, plus 1 as in the distance constraint """
+        stops = self.stops(tractor, route)
+        return 1 + self.distances[stops[:-1], stops[1:]].sum()
+
+    def penalty(self, tractor, demand, nb_fields):
+        """ Hard and medium penalties of a tractor, as a cost """
+        return self.hard_weight * max(0.0, demand - self.capacities[tractor]) + \
+            self.medium_weight * (nb_fields if self.virtual[tractor] else 0)
+
+    def cost(self, tractor, route):
+        """ Cost of a route: penalties, then length """
+        return self.penalty(tractor, self.demands[route].sum(), len(route)) + \
+            self.length(tractor, route)
+
+    def score(self, routes):
+        """ (hard, medium, soft) penalties of routes, as the OptaPy constraints count them """
+        hard, medium, soft = 0, 0, 0
+        for tractor, route in enumerate(routes):
+            demand = self.demands[route].sum()
+            if demand > self.capacities[tractor]:
+                hard += int(demand - self.capacities[tractor])
+            if self.virtual[tractor] and route:
+                medium += len(route)
+            soft += int(self.length(tractor, route))
+        return hard, medium, soft
+
+def exact_routes(problem):
+    """ Best routes, from the shortest tour of each subset of fields from each barn
+        (Held-Karp), then the best split of the fields between the tractors """
+    nb_fields = len(problem.field_locations)
+    nb_subsets = 1 << nb_fields
+    subsets = np.arange(nb_subsets)
+    members = (subsets[:, None] >> np.arange(nb_fields)) & 1 == 1
+    counts = members.sum(axis=1)
+    demands = members @ problem.demands
+    locations = problem.field_locations
+    field_distances = problem.distances[np.ix_(locations, locations)]
+
+    tours = dict()
+    for barn in set(problem.tractor_barns.tolist()):
+        # Shortest path from the barn through a subset, ending on one of its fields
+        lengths = np.full((nb_subsets, nb_fields), np.inf)
+        previous = np.full((nb_subsets, nb_fields), -1)
+        lengths[1 << np.arange(nb_fields), np.arange(nb_fields)] = \
+            problem.distances[barn, locations]
+        for subset in range(1, nb_subsets):
+            outside = np.flatnonzero(~members[subset])
+            if outside.size == 0:
+                continue
+            candidates = lengths[subset][:, None] + field_distances[:, outside]
+            best = candidates.argmin(axis=0)
+            best_lengths = candidates[best, np.arange(outside.size)]
+            extended = subset | (1 << outside)
+            better = best_lengths < lengths[extended, outside]
+            lengths[extended[better], outside[better]] = best_lengths[better]
+            previous[extended[better], outside[better]] = best[better]
+        closed = lengths + problem.distances[locations, barn][None, :]
+        tour_lengths = np.concatenate(([0.0], closed[1:].min(axis=1)))
+        tours[barn] = (tour_lengths, closed.argmin(axis=1), previous)
+
+    # Cost of each subset of fields for each tractor
+    costs = []
+    for tractor, barn in enumerate(problem.tractor_barns):
+        cost = tours[barn][0] + 1 + problem.hard_weight * \
+            np.maximum(0, demands - problem.capacities[tractor])
+        if problem.virtual[tractor]:
+            cost = cost + problem.medium_weight * counts
+        costs.append(cost)
+
+    # Best split of each subset between the first tractors
+    best_costs, choices = [costs[0]], [subsets]
+    for tractor in range(1, len(costs)):
+        tractor_best = np.empty(nb_subsets)
+        tractor_choice = np.empty(nb_subsets, dtype=int)
+        for subset in range(nb_subsets):
+            parts = subsets[(subsets & ~subset) == 0]
+            candidates = best_costs[-1][subset ^ parts] + costs[tractor][parts]
+            best = candidates.argmin()
+            tractor_best[subset], tractor_choice[subset] = candidates[best], parts[best]
+        best_costs.append(tractor_best)
+        choices.append(tractor_choice)
+
+    routes = [[] for _ in costs]
+    subset = nb_subsets - 1
+    for tractor in reversed(range(len(costs))):
+        part = int(choices[tractor][subset])
+        subset ^= part
+        _, last_fields, previous = tours[problem.tractor_barns[tractor]]
+        field = int(last_fields[part])
+        while part:
+            routes[tractor].append(field)
+            part, field = part ^ (1 << field), int(previous[part, field])
+        routes[tractor].reverse()
+    return routes
+
+def construct(problem):
+    """ Nearest neighbour routes: real tractors first, up to their capacity, then the
+        virtual ones. Fields no tractor can take are inserted where they cost least. """
+    remaining = np.ones(len(problem.field_locations), dtype=bool)
+    routes = [[] for _ in problem.tractor_barns]
+    for tractor in np.argsort(problem.virtual, kind='stable'):
+        load, current = 0.0, problem.tractor_barns[tractor]
+        while True:
+            fits = remaining & (load + problem.demands <= problem.capacities[tractor])
+            if not fits.any():
+                break
+            field_distances = np.where(fits, problem.distances[current, problem.field_locations], \
+                np.inf)
+            field = int(field_distances.argmin()) if np.isfinite(field_distances).any() \
+                else int(fits.argmax())
+            routes[tractor].append(field)
+            remaining[field] = False
+            load += problem.demands[field]
+            current = problem.field_locations[field]
+    for field in np.flatnonzero(remaining):
+        best = None
+        for tractor, route in enumerate(routes):
+            for position in range(len(route) + 1):
+                candidate = route[:position] + [int(field)] + route[position:]
+                delta = problem.cost(tractor, candidate) - problem.cost(tractor, route)
+                if best is None or delta < best[0]:
+                    best = (delta, tractor, candidate)
+        routes[best[1]] = best[2]
+    return routes
+
+class LocalSearch:
+    """ Improves routes with the best move of each kind until none improves them:
+        2-opt inside a route, or-opt (segments of fields moved, possibly reversed, inside
+        a route or to another one) and exchanges of two fields between routes """
+    def __init__(self, problem, routes):
+        self.problem = problem
+        self.routes = [list(route) for route in routes]
+        # Penalties only change with loads, they are compared apart from the lengths so
+        # that rounding errors on large costs do not look like improvements
+        self.lengths = [problem.length(tractor, route) \
+            for tractor, route in enumerate(self.routes)]
+
+    def run(self, deadline=None, on_best=None, stop=None):
+        """ Applies improving moves until a local optimum, the deadline, or the stop event
+            is set. on_best(routes) is called with the routes after each improvement. """
+        improved = True
+        while improved and not self.stopped(deadline, stop):
+            improved = False
+            for move in (self.two_opt, self.or_opt, self.exchange):
+                while move():
+                    improved = True
+                    if on_best is not None:
+                        on_best([list(route) for route in self.routes])
+                    if self.stopped(deadline, stop):
+                        return self.routes
+        return self.routes
+
+    @staticmethod
+    def stopped(deadline, stop):
+        """ True once the deadline is passed or the stop event is set """
+        return (deadline is not None and time.perf_counter() >= deadline) or \
+            (stop is not None and stop.is_set())
+
+    def update(self, tractor, route):
+        """ Replaces a route """
+        self.routes[tractor] = route
+        self.lengths[tractor] = self.problem.length(tractor, route)
+
+    def two_opt(self):
+        """ Best reversal of a part of a route, True if one improves it """
+        distances = self.problem.distances
+        best = (-EPSILON, None)
+        for tractor, route in enumerate(self.routes):
+            if len(route) < 2:
+                continue
+            stops = self.problem.stops(tractor, route)
+            first, last = stops[1:-1], stops[1:-1]
+            before, after = stops[:-2], stops[2:]
+            deltas = distances[before[:, None], last[None, :]] + \
+                distances[first[:, None], after[None, :]] - \
+                distances[before, first][:, None] - distances[last, after][None, :]
+            deltas = np.where(np.triu(np.ones(deltas.shape, dtype=bool), 1), deltas, np.inf)
+            start, end = np.unravel_index(deltas.argmin(), deltas.shape)
+            if deltas[start, end] < best[0]:
+                best = (deltas[start, end], (tractor, start, end))
+        if best[1] is None:
+            return False
+        tractor, start, end = best[1]
+        route = self.routes[tractor]
+        self.update(tractor, route[:start] + route[start:end + 1][::-1] + route[end + 1:])
+        return True
+
+    def or_opt(self):
+        """ Best move of a segment of fields to another position, True if one improves
+            the routes """
+        problem = self.problem
+        distances = problem.distances
+        best = (-EPSILON, None)
+        for source, route in enumerate(self.routes):
+            load = problem.demands[route].sum()
+            for length in range(1, min(OR_OPT_MAX_LENGTH, len(route)) + 1):
+                for start in range(len(route) - length + 1):
+                    segment = route[start:start + length]
+                    rest = route[:start] + route[start + length:]
+                    segment_stops = problem.field_locations[segment]
+                    # The segment keeps its inner length, whichever way it is inserted
+                    rest_change = problem.length(source, rest) - self.lengths[source] + \
+                        distances[segment_stops[:-1], segment_stops[1:]].sum()
+                    first, last = segment_stops[0], segment_stops[-1]
+                    demand = problem.demands[segment].sum()
+                    for target, target_route in enumerate(self.routes):
+                        # Cost change apart from the insertion itself
+                        if target == source:
+                            target_route = rest
+                            base = rest_change
+                        else:
+                            target_load = problem.demands[target_route].sum()
+                            base = rest_change + \
+                                problem.penalty(source, load - demand, len(rest)) - \
+                                problem.penalty(source, load, len(route)) + \
+                                problem.penalty(target, target_load + demand, \
+                                len(target_route) + length) - \
+                                problem.penalty(target, target_load, len(target_route))
+                        stops = problem.stops(target, target_route)
+                        before, after = stops[:-1], stops[1:]
+                        removed = distances[before, after]
+                        forward = distances[before, first] + distances[last, after] - removed
+                        backward = distances[before, last] + distances[first, after] - removed
+                        deltas = base + np.minimum(forward, backward)
+                        position = int(deltas.argmin())
+                        if deltas[position] < best[0]:
+                            best = (deltas[position], (source, start, length, target, \
+                                position, backward[position] < forward[position]))
+        if best[1] is None:
+            return False
+        source, start, length, target, position, reverse = best[1]
+        segment = self.routes[source][start:start + length]
+        if reverse:
+            segment = segment[::-1]
+        self.update(source, self.routes[source][:start] + self.routes[source][start + length:])
+        target_route = self.routes[target]
+        self.update(target, target_route[:position] + segment + target_route[position:])
+        return True
+
+    def exchange(self):
+        """ Best exchange of two fields between two routes, True if one improves them """
+        problem = self.problem
+        best = (-EPSILON, None)
+        for first in range(len(self.routes)):
+            for second in range(first + 1, len(self.routes)):
+                if not self.routes[first] or not self.routes[second]:
+                    continue
+                deltas = self.exchange_deltas(first, second) + \
+                    self.exchange_deltas(second, first).T
+                # Penalties only change with the demands of the exchanged fields
+                first_demands = problem.demands[self.routes[first]]
+                second_demands = problem.demands[self.routes[second]]
+                change = second_demands[None, :] - first_demands[:, None]
+                for tractor, sign in ((first, 1), (second, -1)):
+                    load = problem.demands[self.routes[tractor]].sum()
+                    capacity = problem.capacities[tractor]
+                    deltas = deltas + problem.hard_weight * \
+                        (np.maximum(0, load + sign * change - capacity) - max(0.0, load - capacity))
+                position = np.unravel_index(deltas.argmin(), deltas.shape)
+                if deltas[position] < best[0]:
+                    best = (deltas[position], (first, second, *position))
+        if best[1] is None:
+            return False
+        first, second, first_position, second_position = best[1]
+        first_route, second_route = list(self.routes[first]), list(self.routes[second])
+        first_route[first_position], second_route[second_position] = \
+            second_route[second_position], first_route[first_position]
+        self.update(first, first_route)
+        self.update(second, second_route)
+        return True
+
+    def exchange_deltas(self, tractor, other):
+        """ (n,m) length changes of a route when its n fields are replaced by each of the
+            m fields of the other route """
+        distances = self.problem.distances
+        stops = self.problem.stops(tractor, self.routes[tractor])
+        before, fields, after = stops[:-2], stops[1:-1], stops[2:]
+        others = self.problem.field_locations[self.routes[other]]
+        return distances[before[:, None], others[None, :]] + \
+            distances[others[None, :], after[:, None]] - \
+            (distances[before, fields] + distances[fields, after])[:, None]
+
+def solve(problem, time_limit=None, on_best=None, stop=None):
+    """ Returns the routes of the tractors and their (hard, medium, soft) score: exact
+        for a few fields, otherwise local search from nearest neighbour routes, stopped
+        after time_limit seconds or when the stop event is set. on_best(routes, score)
+        is called with each better solution found. """
+    if len(problem.field_locations) <= EXACT_MAX_FIELDS:
+        routes = exact_routes(problem)
+    else:
+        deadline = None if time_limit is None else time.perf_counter() + time_limit
+        routes = construct(problem)
+        if on_best is not None:
+            on_best(routes, problem.score(routes))
+        routes = LocalSearch(problem, routes).run(deadline, None if on_best is None else \
+            lambda better: on_best(better, problem.score(better)), stop)
+    score = problem.score(routes)
+    if on_best is not None and len(problem.field_locations) <= EXACT_MAX_FIELDS:
+        on_best(routes, score)
+    return routes, score
@@ -0,0 +1,138 @@
+""" Shortest paths and distances between points, cached across requests """
+import threading
+from collections import OrderedDict
+
+# Approximate memory of a cache entry, and of each path point or visibility link in it (bytes)
+ENTRY_SIZE = 400
+ITEM_SIZE = 120
+
+class PathCache:
+    """ LRU cache bounded in entries and approximate memory, holding:
+        - 'path': shortest path and length between two points (a pair is stored once,
+          paths are reversed when asked the other way round)
+        - 'length': only the length between two points, from a distance matrix
+        - 'links': visibility graph nodes seen from a point, with their distance
+        Only valid for one PathFinder environment. Safe to use from several threads. """
+    kinds = ('path', 'length', 'links')
+
+    def __init__(self, max_entries=100000, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = dict.fromkeys(self.kinds, 0)
+        self.misses = dict.fromkeys(self.kinds, 0)
+        self.evictions = 0
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def point(coordinates):
+        """ Coordinates as a hashable key """
+        return (float(coordinates[0]), float(coordinates[1]))
+
+    def pair(self, start, goal):
+        """ Key of a pair of points, whatever their order, and whether it is reversed """
+        start, goal = self.point(start), self.point(goal)
+        if start <= goal:
+            return (start, goal), False
+        return (goal, start), True
+
+    def set_limits(self, max_entries, max_bytes):
+        """ Changes the limits, evicting entries if needed """
+        with self.lock:
+            self.max_entries = max_entries
+            self.max_bytes = max_bytes
+            self.evict()
+
+    def lookup(self, kind, key):
+        """ Returns an entry and marks it as recently used, None if missing """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses[kind] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits[kind] += 1
+            return entry[0]
+
+    def store(self, key, value, nb_items):
+        """ Adds or replaces an entry """
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            size = ENTRY_SIZE + ITEM_SIZE * nb_items
+            self.entries[key] = (value, size)
+            self.size += size
+            self.evict()
+
+    def evict(self):
+        """ Removes the least recently used entries beyond the limits """
+        with self.lock:
+            while self.entries and \
+                (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+                _, (_, size) = self.entries.popitem(last=False)
+                self.size -= size
+                self.evictions += 1
+
+    def get_path(self, start, goal):
+        """ Returns (path, length) from start to goal, None if not cached """
+        key, reverse = self.pair(start, goal)
+        entry = self.lookup('path', ('path', *key))
+        if entry is None:
+            return None
+        path, length = entry
+        return (path[::-1] if reverse else list(path)), length
+
+    def put_path(self, start, goal, path, length):
+        """ Stores the path from start to goal and its length (None if there is no path) """
+        with self.lock:
+            key, reverse = self.pair(start, goal)
+            self.store(('path', *key), (path[::-1] if reverse else list(path), length), \
+                len(path))
+            self.entries.pop(('length', *key), None)
+
+    def get_length(self, start, goal):
+        """ Returns the shortest path length (inf if there is no path), None if not cached """
+        with self.lock:
+            key, _ = self.pair(start, goal)
+            entry = self.entries.get(('path', *key))
+            if entry is not None:
+                self.entries.move_to_end(('path', *key))
+                self.hits['length'] += 1
+                length = entry[0][1]
+                return float('inf') if length is None else length
+            return self.lookup('length', ('length', *key))
+
+    def put_length(self, start, goal, length):
+        """ Stores the shortest path length, unless the whole path is already cached """
+        with self.lock:
+            key, _ = self.pair(start, goal)
+            if ('path', *key) not in self.entries:
+                self.store(('length', *key), length, 0)
+
+    def get_links(self, point):
+        """ Returns {graph node: distance} visible from point, None if not cached """
+        return self.lookup('links', ('links', self.point(point)))
+
+    def put_links(self, point, links):
+        """ Stores the graph nodes visible from point """
+        self.store(('links', self.point(point)), links, len(links))
+
+    def clear(self):
+        """ Removes all entries """
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        """ Usage statistics """
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'approximate_bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': dict(self.hits),
+                'misses': dict(self.misses),
+                'evictions': self.evictions
+            }
@@ -1,5 +1,17 @@
 """ PathFinder functions """
+import threading
+
+import numpy as np
+
 import map_definition
+from path_cache import PathCache
+
+# Shortest paths and distances, shared by all requests (limits are set by the app)
+path_cache = PathCache()
+# Distance rasters from the barns, if enabled by the app
+barn_distances = None
+# Shortest path queries store temporary data in the environment, one at a time
+environment_lock = threading.Lock()
 
 # Path calculation functions
 def translate_coordinates(coordinates):
@@ -10,11 +22,16 @@ def translate_coordinates(coordinates):
     return (x,map_definition.MAP_HEIGHT-y)
 
 def translate_destinations(destinations):
-    """ Translates an array of coordinates """
-    translated_destinations = []
-    for coordinates in destinations:
-        translated_destinations.append(translate_coordinates(coordinates))
-    return translated_destinations
+    """ Translates an array of coordinates, all at once """
+    points = np.array(destinations, dtype=float).reshape(-1, 2)
+    points[:, 1] = map_definition.MAP_HEIGHT - points[:, 1]
+    return [tuple(point) for point in points.tolist()]
+
+def encode_route(route):
+    """ Compact route: coordinates rounded to whole units, the first point then the
+        difference from the previous point, flattened as [x0, y0, dx1, dy1, ...] """
+    points = np.rint(np.array(route, dtype=float).reshape(-1, 2)).astype(np.int64)
+    return np.concatenate((points[:1], np.diff(points, axis=0))).ravel().tolist()
 
 def initialize_environment(pathfinder_environment):
     """ Initialize pathfinder environment """
@@ -40,7 +57,13 @@ def calculate_path(pathfinder_environment,start_coordinates, goal_coordinates):
     """ Finds shortest path, returns array and length """
     # Start and goal have to be in the same referential as PathFinder
     # Please translate if needed before submitting to the function
-    path, length = \
-        pathfinder_environment.find_shortest_path(start_coordinates, goal_coordinates)
+    cached = path_cache.get_path(start_coordinates, goal_coordinates)
+    if cached is not None:
+        return cached
+
+    with environment_lock:
+        path, length = \
+            pathfinder_environment.find_shortest_path(start_coordinates, goal_coordinates)
+    path_cache.put_path(start_coordinates, goal_coordinates, path, length)
 
-    return path, length
+    return list(path), length
@@ -0,0 +1,225 @@
+""" Route solving jobs: solved on a bounded thread pool, off the event loop, with the
+    improving solutions published while solving so tractors can start on the first
+    feasible route """
+import asyncio
+import functools
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import route_solver
+
+# Job statuses, the last three are final
+QUEUED = 'queued'
+SOLVING = 'solving'
+DONE = 'done'
+CANCELLED = 'cancelled'
+FAILED = 'failed'
+FINISHED = (DONE, CANCELLED, FAILED)
+
+class RouteJob:
+    """ A route problem being solved and the best route found so far. Its state only
+        changes on the event loop: the solving thread schedules the changes there. """
+    def __init__(self, kind, solver, loop):
+        self.job_id = str(uuid.uuid4())
+        self.kind = kind
+        self.solver = solver
+        self.loop = loop
+        self.status = QUEUED
+        self.route = None
+        self.score = None
+        self.feasible = False
+        self.timings = dict()
+        self.error = None
+        # Published states, in order, and the clients waiting for the next one
+        self.states = []
+        self.waiters = []
+        self.finished = loop.create_future()
+        # Cancellation, and how to stop the solver once it runs (solving thread side)
+        self.lock = threading.Lock()
+        self.cancelled = False
+        self.started = False
+        self.terminate = None
+        self.last_publish = 0.0
+        self.best = None
+
+    def state(self):
+        """ Job state, as sent to clients """
+        return {
+            'job_id': self.job_id,
+            'kind': self.kind,
+            'solver': self.solver,
+            'status': self.status,
+            'route': self.route,
+            'score': self.score,
+            'feasible': self.feasible,
+            'timings': {name: round(elapsed * 1000, 2) for name, elapsed in self.timings.items()},
+            'error': self.error
+        }
+
+    def update(self, **changes):
+        """ Changes the state and wakes up the clients waiting for it (event loop only) """
+        if self.status in FINISHED:
+            return
+        for name, value in changes.items():
+            setattr(self, name, value)
+        self.states.append(self.state())
+        for waiter in self.waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self.waiters = []
+        if self.status in FINISHED:
+            self.finished.set_result(self.state())
+
+    def publish(self, **changes):
+        """ Changes the state, from any thread """
+        self.loop.call_soon_threadsafe(functools.partial(self.update, **changes))
+
+    async def updates(self):
+        """ All the published states, then each new one until the job is finished """
+        index = 0
+        while True:
+            while index < len(self.states):
+                index += 1
+                yield self.states[index - 1]
+            if self.status in FINISHED:
+                return
+            waiter = self.loop.create_future()
+            self.waiters.append(waiter)
+            await waiter
+
+    def cancel(self):
+        """ Stops the solving: the best route so far becomes the result.
+            Returns True if the job was still queued: it will not be solved """
+        with self.lock:
+            self.cancelled = True
+            terminate = self.terminate
+            queued = not self.started
+        if terminate is not None:
+            terminate()
+        return queued
+
+    def start(self):
+        """ Marks the job as solving, returns False if it was cancelled while queued
+            (solving thread) """
+        with self.lock:
+            self.started = not self.cancelled
+            return self.started
+
+    def solver_started(self, terminate):
+        """ Keeps the function stopping the solver, calls it if already cancelled.
+            Returns True if cancelled """
+        with self.lock:
+            self.terminate = terminate
+            cancelled = self.cancelled
+        if cancelled:
+            terminate()
+        return cancelled
+
+class RouteJobs:
+    """ Runs route jobs on at most `workers` threads, with at most max_pending jobs
+        queued or solving, and keeps the last `history` finished ones """
+    def __init__(self, environment, workers=2, max_pending=8, history=100, \
+        publish_interval=0.5):
+        self.environment = environment
+        self.workers = workers
+        self.max_pending = max_pending
+        self.history = history
+        # Improving solutions are published at most this often (seconds), apart from the
+        # first feasible one and the final one
+        self.publish_interval = publish_interval
+        self.jobs = OrderedDict()
+        self.executor = None
+        self.loop = None
+
+    def start(self):
+        """ Starts the worker threads, must be called from the event loop """
+        self.loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='route')
+        print(f'Route jobs: {self.workers} workers, {self.max_pending} pending max')
+
+    def stop(self):
+        """ Cancels the jobs and stops the worker threads, the queued jobs finish
+            at once """
+        for job in self.jobs.values():
+            self.cancel(job)
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    def pending(self):
+        """ Number of jobs queued or solving """
+        return sum(1 for job in self.jobs.values() if job.status not in FINISHED)
+
+    def get(self, job_id):
+        """ Returns a job, None if unknown """
+        return self.jobs.get(job_id)
+
+    async def slot(self):
+        """ Waits until fewer than max_pending jobs are queued or solving """
+        while self.pending() >= self.max_pending:
+            await asyncio.wait([job.finished for job in self.jobs.values() \
+                if job.status not in FINISHED], return_when=asyncio.FIRST_COMPLETED)
+
+    def submit(self, kind, solver, destinations):
+        """ Queues a route job, returns None if too many jobs are pending """
+        if self.pending() >= self.max_pending:
+            return None
+        job = RouteJob(kind, solver, self.loop)
+        self.jobs[job.job_id] = job
+        self.forget_finished()
+        if destinations:
+            self.executor.submit(self.run, job, list(destinations))
+        else:
+            job.update(status=DONE, route=[(-1,-1)])
+        return job
+
+    def cancel(self, job):
+        """ Cancels a job: a queued one at once, without route as when there is no
+            destination, a solving one keeps its best route """
+        if job.cancel():
+            job.update(status=CANCELLED, route=[(-1,-1)])
+
+    def forget_finished(self):
+        """ Removes the oldest finished jobs beyond the history size """
+        finished = [job_id for job_id, job in self.jobs.items() if job.status in FINISHED]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self.jobs[job_id]
+
+    def run(self, job, destinations):
+        """ Solves a job (worker thread) """
+        if not job.start():
+            # Cancelled while queued, already finished by RouteJobs.cancel
+            return
+        job.publish(status=SOLVING)
+        try:
+            route, timings = route_solver.routefinder(self.environment, job.kind, \
+                destinations, solver=job.solver, \
+                on_best=functools.partial(self.best_solution, job), on_start=job.solver_started)
+            score, feasible = job.best or (None, False)
+            if job.best is None and job.cancelled:
+                # Cancelled before any solution, as when cancelled while queued
+                route = [(-1,-1)]
+            job.publish(status=CANCELLED if job.cancelled else DONE, route=route, \
+                score=score, feasible=feasible, timings=timings)
+        except Exception as ex: # pylint: disable=broad-except
+            print(f'Route job {job.job_id} failed: {ex!r}')
+            job.publish(status=FAILED, error=str(ex))
+
+    def best_solution(self, job, solution, legs=None):
+        """ Publishes the route of a new best solution, unless one was published less
+            than publish_interval ago (solving thread). legs are the paths kept by the
+            distance computation. """
+        if solution.score is None:
+            return
+        score, feasible = str(solution.score), solution.score.getHardScore() >= 0
+        first_feasible = feasible and not (job.best and job.best[1])
+        job.best = (score, feasible)
+        now = time.perf_counter()
+        if not first_feasible and now - job.last_publish < self.publish_interval:
+            return
+        job.last_publish = now
+        job.publish(route=route_solver.solution_route(self.environment, job.kind, solution, legs), \
+            score=score, feasible=feasible)
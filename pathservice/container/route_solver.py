@@ -1,18 +1,25 @@
 """ Route solving module, using OptaPlanner """
+import functools
+import threading
+import time
 from itertools import groupby
 
 import optapy
 optapy.init('-Xms256m','-Xmx512m')
 
 import map_definition
+import numpy as np
+import numpy_solver
 import optapy.config
 import pathfinder
+from distance_matrix import LegPaths, distance_matrix
 from java.lang import System
 from optapy import (constraint_provider, planning_entity,
                     planning_entity_collection_property,
                     planning_list_variable, planning_score, planning_solution,
                     problem_fact, problem_fact_collection_property,
                     solver_factory_create, value_range_provider)
+from optapy.optaplanner_java_interop import _unwrap_java_object
 from optapy.score import HardMediumSoftScore
 from optapy.types import Duration
 from pathfinder import calculate_path as pf_cp
@@ -24,21 +31,29 @@ from pathfinder import translate_coordinates as pf_tc
 # the problem facts are the locations a tractor can visit, the barns,
 # and the fields to visit.
 
+# Distance between locations with no path between them, a score penalty
+# that cannot overflow when summed over a route
+UNREACHABLE_DISTANCE = 1000000
+
 @problem_fact
 class Location:
-    """ Location coordinates, as well as the distances from every other locations """
-    def __init__(self, x, y, distance_map=None):
+    """ Location coordinates, its index in the LocationRegistry of the problem, and its
+        row of the distances matrix: a list the solver reads by index instead of hashing
+        locations. No __slots__: OptaPy copies the instance __dict__ to Java. """
+    def __init__(self, x, y, index=None, distances=None):
         self.x = x
         self.y = y
-        self.distance_map = distance_map
+        self.index = index
+        self.distances = distances
 
-    def set_distance_map(self, distance_map):
+    def set_distances(self, index, distances):
         """ Self explanatory """
-        self.distance_map = distance_map
+        self.index = index
+        self.distances = distances
 
     def get_distance_to(self, location):
         """ Self explanatory """
-        return self.distance_map[location]
+        return self.distances[location.index]
 
     def to_x_y_tuple(self):
         """ Self explanatory """
@@ -50,27 +65,41 @@ class Location:
     def __str__(self):
         return f'[{self.x}, {self.y}]'
 
-@problem_fact
-class DistanceCalculator:
-    """ Compute and initialize distance maps """
+class LocationRegistry:
+    """ The locations of a problem, one per coordinates, each with a dense index, and
+        the shortest path lengths between them as an (n,n) float32 array, which other
+        solvers can use as it is. The paths found are kept in legs. """
     def __init__(self):
-        pass
-
-    def calculate_distance(self, environment,start, end):
-        """ Compute path length using Pathfinder """
-        if start == end:
-            return 0
-        result = pf_cp(environment,(start.x,start.y),(end.x,end.y))
-        return result[1]
-
-    def init_distance_maps(self, environment,location_list):
-        """ Initializes distances between each points pairs """
-        for location in location_list:
-            distance_map = dict()
-            for other_location in location_list:
-                distance_map[other_location] = \
-                    self.calculate_distance(environment,location, other_location)
-            location.set_distance_map(distance_map)
+        self.locations = []
+        self.indexes = dict()
+        self.distances = None
+        self.legs = LegPaths()
+
+    def add(self, x, y):
+        """ Location at coordinates, the registered one if any """
+        if (x, y) not in self.indexes:
+            self.indexes[(x, y)] = len(self.locations)
+            self.locations.append(Location(x, y, len(self.locations)))
+        return self.locations[self.indexes[(x, y)]]
+
+    def compute_distances(self, environment):
+        """ Computes the distances between all the locations, with one shortest path
+            search per location instead of one per pair, and gives each location its
+            row of distances """
+        coordinates = [location.to_x_y_tuple() for location in self.locations]
+        # Barn distances come from the precomputed rasters, through the path cache
+        if pathfinder.barn_distances is not None:
+            pathfinder.barn_distances.fill_cache(environment, coordinates, pathfinder.path_cache)
+        distances = distance_matrix(environment, coordinates, pathfinder.path_cache, self.legs)
+        self.distances = distances.astype(np.float32)
+        # The distance constraint sums up the rows in full precision
+        rows = np.minimum(distances, UNREACHABLE_DISTANCE).tolist()
+        for location, row in zip(self.locations, rows):
+            location.set_distances(location.index, row)
+
+    def get_distance(self, start, end):
+        """ Self explanatory """
+        return float(self.distances[start.index, end.index])
 
 @problem_fact
 class Barn:
@@ -271,8 +300,38 @@ class TractorRoutingSolution:
 
 ## Solving
 
-def routefinder(environment,kind,destinations):
-    """ Main function """
+# Stop after 4 seconds with no score improvement, after 6 seconds max anyway
+UNIMPROVED_SPENT_LIMIT = 4
+SPENT_LIMIT = 6
+# Solvers a route request can ask for: OptaPlanner, or the NumPy heuristics (no JVM)
+SOLVERS = ('optapy', 'numpy')
+
+# Solver factories by termination limits: building one generates the Java classes of the
+# domain, solvers are then built from it for each request (a solver is not thread safe)
+solver_factories = dict()
+solver_factories_lock = threading.Lock()
+
+def get_solver_factory(unimproved_spent_limit=UNIMPROVED_SPENT_LIMIT, spent_limit=SPENT_LIMIT):
+    """ Returns the solver factory of a configuration, created on first use """
+    key = (unimproved_spent_limit, spent_limit)
+    with solver_factories_lock:
+        if key not in solver_factories:
+            termination_config = optapy.config.solver.termination.TerminationConfig()
+            termination_config.setUnimprovedSpentLimit(Duration.ofSeconds(unimproved_spent_limit))
+            termination_config.setSpentLimit(Duration.ofSeconds(spent_limit))
+
+            solver_config = optapy.config.solver.SolverConfig()
+            solver_config \
+                .withSolutionClass(TractorRoutingSolution) \
+                .withEntityClasses(Tractor) \
+                .withConstraintProviderClass(tractor_routing_constraints) \
+                .withTerminationConfig(termination_config)
+            solver_factories[key] = solver_factory_create(solver_config)
+        return solver_factories[key]
+
+def build_problem(environment, kind, destinations):
+    """ Tractor routing problem for the barns and tractors of a kind of crop,
+        and the registry of its locations, with the distances between them """
     name = 'data'
 
     # We have to translate all inputs
@@ -281,10 +340,11 @@ def routefinder(environment,kind,destinations):
     north_east_corner = \
         Location(*pf_tc(map_definition.north_east_corner))
 
+    registry = LocationRegistry()
     barn_list = []
     for barn in (barn for barn in map_definition.barns if barn['kind'] == kind):
         barn_list.append(Barn(barn['name'], \
-            Location(*pf_tc(barn['location'])),kind))
+            registry.add(*pf_tc(barn['location'])),kind))
 
     tractor_list = []
     for tractor in (tractor for tractor in map_definition.tractors if tractor['kind'] == kind):
@@ -294,61 +354,151 @@ def routefinder(environment,kind,destinations):
     field_list = []
     for i, destination in enumerate(destinations):
         field_list.append(Field('field-'+str(i), \
-            Location(*pf_tc(destination)),1))
-
-    location_list = []
-    for barn in barn_list:
-        location_list.append(barn.location)
-    for field in field_list:
-        location_list.append(field.location)
-
-    DistanceCalculator().init_distance_maps(environment,location_list)
-
-    problem = TractorRoutingSolution(name, location_list, barn_list, tractor_list, \
-         field_list, south_west_corner, north_east_corner)
-
-    # Solve the problem
-    singleton_id = 1
-    termination_config = optapy.config.solver.termination.TerminationConfig()
-    # Stop after 4 seconds with no score improvement
-    termination_config.setUnimprovedSpentLimit(Duration.ofSeconds(4))
-    # Stop after 6 seconds max anyway
-    termination_config.setSpentLimit(Duration.ofSeconds(6))
-
-    solver_config = optapy.config.solver.SolverConfig()
-    solver_config \
-        .withSolutionClass(TractorRoutingSolution) \
-        .withEntityClasses(Tractor) \
-        .withConstraintProviderClass(tractor_routing_constraints) \
-        .withTerminationConfig(termination_config)
-
-    solver = solver_factory_create(solver_config).buildSolver()
-    solution = solver.solve(problem)
-
-    verts=dict()
-
-    for tractor in solution.tractor_list:
-        verts[tractor.name] = []
-        # We start from the barn
-        verts[tractor.name].append((tractor.barn.location.x,tractor.barn.location.y))
-        # Then add the destinations
-        verts[tractor.name].extend(map(lambda field: \
-            (field.location.x,field.location.y), \
-            tractor.field_list))
-        # Add back to the barn
-        verts[tractor.name].append((tractor.barn.location.x,tractor.barn.location.y))
+            registry.add(*pf_tc(destination)),1))
+
+    registry.compute_distances(environment)
+
+    return TractorRoutingSolution(name, registry.locations, barn_list, tractor_list, \
+         field_list, south_west_corner, north_east_corner), registry
+
+def solve(problem, timings, time_limit=None, on_best=None, on_start=None):
+    """ Solves a problem with the cached solver factory, stopping early after
+        time_limit seconds if given. on_best(solution) is called with each new best
+        solution, on_start(terminate) with a function stopping the solving early: it
+        returns True if the solving is stopped already, the problem is then returned
+        unsolved. Records 'solver_setup' and 'solving' timings, and prints the number of moves
+        evaluated per second (score calculation speed). """
+    start = time.perf_counter()
+    solver = get_solver_factory().buildSolver()
+    started = threading.Event()
+
+    def best_solution_changed(event):
+        """ Reports a new best solution """
+        # solver.solve resets terminateEarly as it starts: a stop asked for in between
+        # is asked for again once solving
+        if not started.is_set():
+            started.set()
+            if on_start is not None:
+                on_start(solver.terminateEarly)
+        if on_best is not None:
+            # The event holds the Java copy of the solution, on_best gets the Python one
+            # (as with SolverManager.solveAndListen)
+            on_best(_unwrap_java_object(event.getNewBestSolution()))
+
+    solver.addEventListener(best_solution_changed)
+    timings['solver_setup'] = time.perf_counter() - start
+
+    if on_start is not None and on_start(solver.terminateEarly):
+        timings['solving'] = 0.0
+        return problem
+    timer = None
+    if time_limit is not None:
+        timer = threading.Timer(time_limit, solver.terminateEarly)
+        timer.start()
+    start = time.perf_counter()
+    try:
+        solution = solver.solve(problem)
+    finally:
+        if timer is not None:
+            timer.cancel()
+    timings['solving'] = time.perf_counter() - start
+    solver_scope = solver.getSolverScope()
+    print(f'Route solved: {solver_scope.getScoreCalculationCount()} moves evaluated, ' \
+        f'{solver_scope.getScoreCalculationSpeed()}/s')
+    return solution
+
+def solve_numpy(problem, registry, timings, time_limit=None, on_best=None, on_start=None):
+    """ Solves a problem with the NumPy heuristics, on the registry indexes of its locations,
+        and puts the fields in the tractors of the problem. on_best and on_start are
+        called as by solve. Records 'solving' timing. """
+    start = time.perf_counter()
+    # In double precision: the heuristics add large penalty weights to the lengths.
+    # Capped as the OptaPy constraints see them: unreachable fields are costly, not inf
+    routing_problem = numpy_solver.RoutingProblem( \
+        np.minimum(registry.distances, UNREACHABLE_DISTANCE).astype(float), \
+        [tractor.barn.location.index for tractor in problem.tractor_list], \
+        [tractor.capacity for tractor in problem.tractor_list], \
+        [tractor.is_virtual for tractor in problem.tractor_list], \
+        [field.location.index for field in problem.field_list], \
+        [field.demand for field in problem.field_list])
+
+    def set_solution(routes, score):
+        """ Puts routes and their score in the problem """
+        hard, medium, soft = score
+        for tractor, route in zip(problem.tractor_list, routes):
+            tractor.set_field_list([problem.field_list[field] for field in route])
+        problem.set_score(HardMediumSoftScore.of(-hard, -medium, -soft))
+
+    def set_best_solution(routes, score):
+        """ Puts a new best solution in the problem, and reports it """
+        set_solution(routes, score)
+        on_best(problem)
+
+    stop = threading.Event()
+    if on_start is not None and on_start(stop.set):
+        timings['solving'] = time.perf_counter() - start
+        return problem
+    set_solution(*numpy_solver.solve(routing_problem, \
+        SPENT_LIMIT if time_limit is None else time_limit, \
+        None if on_best is None else set_best_solution, stop))
+    timings['solving'] = time.perf_counter() - start
+    return problem
+
+def solution_route(environment, kind, solution, legs=None):
+    """ Full path of the first tractor of a kind, in the frontend referential.
+        The paths between stops come from legs (LegPaths) when they were kept. """
+    tractor = next(tractor for tractor in solution.tractor_list if tractor.name == kind+'-0')
+    barn = tractor.barn.location.to_x_y_tuple()
+    stops = [barn] + [field.location.to_x_y_tuple() for field in tractor.field_list] + [barn]
 
     # solver does not take obstacles into account, only distances
     # (although distances have been calculated with full path)
-    # So let's parse it again to have the full path
+    # So let's get the path between each stop
     full_path = []
-    for i in range(len(verts[kind+'-0'])-1):
-        full_path = full_path + pf_cp(environment, verts[kind+'-0'][i], \
-            verts[kind+'-0'][i+1])[0]
+    for start, goal in zip(stops, stops[1:]):
+        path = None if legs is None else legs.get(start, goal)
+        if path is None:
+            path = pf_cp(environment, start, goal)[0]
+        full_path.extend(tuple(coordinates) for coordinates in path)
 
     # Now let's remove duplicates
     cleaned_path = [k for k, g in groupby(full_path)]
     # And finally translate coordinates
-    translated_clean_path = pathfinder.translate_destinations(cleaned_path)
+    return pathfinder.translate_destinations(cleaned_path)
+
+def routefinder(environment,kind,destinations,time_limit=None,solver='optapy', \
+    on_best=None,on_start=None):
+    """ Main function, returns the route and the time spent in each step (seconds):
+        'problem' (locations and distances), 'solver_setup' (OptaPy only), 'solving'
+        and 'path'. on_best(solution, legs) is called with each new best solution while
+        solving, legs being the paths to pass to solution_route, on_start(terminate)
+        with a function stopping the solving early. """
+    timings = dict()
+    start = time.perf_counter()
+    problem, registry = build_problem(environment, kind, destinations)
+    timings['problem'] = time.perf_counter() - start
+    if on_best is not None:
+        on_best = functools.partial(on_best, legs=registry.legs)
 
-    return translated_clean_path
+    # Solve the problem
+    if solver == 'numpy':
+        solution = solve_numpy(problem, registry, timings, time_limit, on_best, on_start)
+    else:
+        solution = solve(problem, timings, time_limit, on_best, on_start)
+
+    start = time.perf_counter()
+    route = solution_route(environment, kind, solution, registry.legs)
+    timings['path'] = time.perf_counter() - start
+
+    return route, timings
+
+def warm_up(environment, time_limit=2):
+    """ Solves a small problem per kind of crop, so the first requests do not pay for
+        the solver factory creation, class loading and JIT compilation """
+    start = time.perf_counter()
+    for kind in dict.fromkeys(barn['kind'] for barn in map_definition.barns):
+        # Fields on the barns of the other kinds, which lie within the map
+        destinations = [barn['location'] for barn in map_definition.barns \
+            if barn['kind'] != kind]
+        routefinder(environment, kind, destinations, time_limit)
+    print(f'Route solver warmed up in {time.perf_counter() - start:.1f}s')
@@ -0,0 +1,53 @@
+""" Checks the barn distance rasters against exact shortest path lengths.
+    Run with: python -m pytest test_barn_distances.py """
+import numpy as np
+import pytest
+
+extremitypathfinder = pytest.importorskip('extremitypathfinder')
+
+import pathfinder # pylint: disable=wrong-import-position
+from barn_distances import BarnDistances, on_edges # pylint: disable=wrong-import-position
+
+@pytest.fixture(scope='module')
+def environment():
+    """ PathFinder environment of the map """
+    pathfinder_environment = extremitypathfinder.PolygonEnvironment()
+    pathfinder.initialize_environment(pathfinder_environment)
+    return pathfinder_environment
+
+@pytest.fixture(scope='module')
+def barn_distances(environment, tmp_path_factory): # pylint: disable=redefined-outer-name
+    """ Rasters computed from scratch """
+    distances = BarnDistances(str(tmp_path_factory.mktemp('barn_distances')), 10)
+    distances.load(environment)
+    return distances
+
+def test_on_edges():
+    """ Points on an edge or a vertex, not on its line beyond the vertices """
+    edges = np.array([[[0, 180], [108, 240]]], dtype=float)
+    points = np.array([[45, 205], [0, 180], [108, 240], [216, 300], [45, 206]], dtype=float)
+    assert on_edges(points, edges).tolist() == [True, True, True, False, False]
+
+def test_edge_aligned_centers(environment, barn_distances): # pylint: disable=redefined-outer-name
+    """ Cells centered on a map edge, e.g. (45,205) on (0,180)-(108,240), have no raster value:
+        their points get exact lengths """
+    centers = barn_distances.cell_centers()
+    edges = environment.coords[environment.edge_vertex_idxs]
+    aligned = on_edges(centers, edges)
+    assert aligned.any()
+    for location, raster in barn_distances.rasters.items():
+        assert np.isinf(np.asarray(raster).ravel()[aligned]).all()
+        point = (47.9, 206.17)
+        assert barn_distances.length(environment, location, point) == \
+            pytest.approx(barn_distances.exact_length(environment, location, point))
+
+def test_raster_values(environment, barn_distances): # pylint: disable=redefined-outer-name
+    """ Finite raster values are the exact lengths to the cell centers, which are in the map """
+    centers = barn_distances.cell_centers()
+    for location, raster in barn_distances.rasters.items():
+        values = np.asarray(raster).ravel()
+        for center, value in zip(centers, values):
+            if np.isfinite(value):
+                assert environment.within_map(center)
+                assert value == pytest.approx(barn_distances.exact_length(environment, \
+                    location, tuple(center)), rel=1e-4)